@@ -1,9 +1,9 @@
+from .lib import cachelib, searchlib, tokenlib
 from .lib.settingslib import SettingsLib
 from .lib.widgetlib import WidgetLib
-from .models import DBSession
-from .security import groupfinder
+from .models import DBSession, upgrade_schema
+from .security import groupfinder, IndexedACLAuthorizationPolicy
 from pyramid.authentication import AuthTktAuthenticationPolicy
-from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
 from pyramid.events import BeforeRender
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
@@ -29,11 +29,15 @@ def main(global_config, **settings):
     # Get database settings
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
+    upgrade_schema(engine)
+    cachelib.configure(settings)
+    searchlib.configure(settings)
+    tokenlib.configure(settings, get_uuid("token_uuid.txt"))
 
     # Setup auth + auth policy's
     authentication_policy = AuthTktAuthenticationPolicy(get_uuid("auth_uuid.txt"),
                                                         callback=groupfinder)
-    authorization_policy = ACLAuthorizationPolicy()
+    authorization_policy = IndexedACLAuthorizationPolicy()
 
     # Configure session support
     session_factory = UnencryptedCookieSessionFactoryConfig(get_uuid("sess_uuid.txt"))
@@ -1,13 +1,13 @@
-from ..factory import RootFactory
-from ..models import DBSession
+from ..factory import compiled_acl
 from .userarea import EditUserSchema
 from colander import (Schema, SchemaNode, String, OneOf, SequenceSchema, Integer, 
-                      MappingSchema, deferred, Boolean, Set)
+                      MappingSchema, deferred, Boolean, Set, Invalid)
 from deform import FileData
 from deform.widget import SelectWidget, TextAreaWidget, FileUploadWidget
 from pyramid.security import Everyone
 from ..lib.userlib import UserLib
 from ..lib.helperlib import list_routes
+from ..lib.menulib import parse_route_json, InvalidRouteJson
 
 class MemoryTmpStore(dict):
     """ Instances of this class implement the
@@ -21,9 +21,8 @@ def double_up(items):
     return [(x, x) for x in items]
 
 def get_acl(single_result=False):
-    rf = RootFactory(session=DBSession)
     result = []
-    for item in rf.__acl__:
+    for item in compiled_acl():
         if item != Everyone:
             if single_result:
                 result.append(item[2])
@@ -75,6 +74,12 @@ def deferred_route_name_validator(node, kw):
     data = list(list_routes(kw['request']))
     return OneOf(data)
 
+def valid_route_json(node, value):
+    try:
+        parse_route_json(value)
+    except InvalidRouteJson:
+        raise Invalid(node, 'Route arguments must be a JSON object.')
+
 class MenuItem(Schema):
     name = SchemaNode(String())
     type = SchemaNode(String(),
@@ -85,7 +90,8 @@ class MenuItem(Schema):
                             widget=deferred_route_name_widget,
                             validator=deferred_route_name_validator,
                             default="article_read")
-    route_json = SchemaNode(String(), missing='{}')
+    route_json = SchemaNode(String(), missing='{}',
+                            validator=valid_route_json)
     url = SchemaNode(String(), missing='')
     permissions = SchemaNode(String(), widget=deferred_acl_widget,
                              validator=deferred_acl_validator, 
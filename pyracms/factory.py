@@ -1,56 +1,134 @@
+from .lib.cachelib import CachedValue, ACL
 from .lib.settingslib import SettingsLib, SettingNotFound
 from .models import DBSession
 from collections import UserList
+from weakref import WeakKeyDictionary
 import json
+import transaction
 
-def save(obj):
-    hashable = tuple([tuple(x) for x in obj])
-    obj.json = json.dumps(list(set(hashable)), indent=4)
-    try:
-        obj.settings.update("ACL", obj.json)
-    except SettingNotFound:
-        obj.settings.create("ACL", obj.json)
+MUTATORS = ["__setitem__", "__delitem__", "__iadd__", "__imul__", "append",
+            "insert", "pop", "remove", "clear", "reverse", "sort", "extend"]
+
+# The first JsonList made in each transaction
+_owners = WeakKeyDictionary()
 
 class JsonList(UserList):
+    """
+    The access control list, stored as JSON in the ACL setting.
+    Every JsonList of a transaction shares the list of the first one made
+    in it. Mutating the list marks it dirty, it is saved once just before
+    the transaction commits.
+    """
     def __init__(self, *args, **kwargs):
-        session = None
-        try:
-            session = kwargs['session']
-            del(kwargs['session'])
-        except KeyError:
-            pass
+        session = kwargs.pop('session', None)
         self.settings = SettingsLib(session)
+        txn = transaction.get()
+        owner = _owners.get(txn)
+        if owner is None:
+            owner = _owners[txn] = self
+            self._dirty = False
+        self.owner = owner
         if args:
             super().__init__(*args, **kwargs)
-            save(self)
+            if owner is not self:
+                owner.data[:] = self.data
+                self.data = owner.data
+            self.changed()
+        elif owner is not self:
+            super().__init__()
+            self.data = owner.data
         else:
             try:
-                DBSession.flush()
                 db_data = self.settings.show_setting("ACL")
                 super().__init__(json.loads(db_data))
             except SettingNotFound:
                 super().__init__()
-                save(self)
-            
-    def __getattribute__(self,name):
-        attr = super(UserList, self).__getattribute__(name)
-        if hasattr(attr, '__call__'):
-            def newfunc(*args, **kwargs):
-                result = attr(*args, **kwargs)
-                save(self)
-                return result
-            return newfunc
-        else:
-            return attr
+                self.changed()
+
+    @property
+    def dirty(self):
+        return self.owner._dirty
+
+    # UserList builds copies, slices and sums with the class, which would
+    # replace the shared list. They are plain lists instead.
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __add__(self, other):
+        return self.data + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.data
+
+    def __mul__(self, n):
+        return self.data * n
+
+    __rmul__ = __mul__
+
+    def copy(self):
+        return list(self.data)
+
+    def changed(self):
+        """
+        Mark the list dirty, schedule a save for the end of the transaction
+        """
+        owner = self.owner
+        if not owner._dirty:
+            owner._dirty = True
+            transaction.get().addBeforeCommitHook(owner.save)
+
+    def save(self):
+        """
+        Write the list to the ACL setting, dropping duplicate entries
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        hashable = [tuple(x) for x in self]
+        self.json = json.dumps(list(dict.fromkeys(hashable)), indent=4)
+        try:
+            self.settings.update("ACL", self.json)
+        except SettingNotFound:
+            self.settings.create("ACL", self.json)
+
+def mutator(name):
+    method = getattr(UserList, name)
+    def mutate(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.changed()
+        return result
+    mutate.__name__ = name
+    return mutate
+
+for name in MUTATORS:
+    setattr(JsonList, name, mutator(name))
+
+def load_acl(session):
+    try:
+        db_data = SettingsLib(session).show_setting("ACL")
+    except SettingNotFound:
+        return ()
+    return tuple(tuple(x) for x in json.loads(db_data))
+
+_acl = CachedValue(load_acl, ACL)
+
+def compiled_acl(session=None):
+    """
+    Get the access control list as a tuple of tuples, shared by every
+    request until the ACL setting changes.
+    """
+    return _acl.get(session or DBSession)
 
 class RootFactory(object):
     """
     Default context for views.
+    Given a session, as init scripts do, __acl__ is a JsonList that can
+    be changed, otherwise it is the shared compiled tuple.
     """
     
     def __init__(self, request=None, session=None):
         self.request = request
-        if session:
+        if session is not None:
             self.__acl__ = JsonList(session=session)
         else:
-            self.__acl__ = JsonList(session=DBSession)
+            self.__acl__ = compiled_acl()
@@ -0,0 +1,260 @@
+from ..models import DBSession, CacheGeneration
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, scoped_session
+from threading import Lock
+from time import time
+from weakref import WeakSet
+from zope.sqlalchemy import mark_changed
+
+SETTINGS = "settings"
+ACL = "acl"
+MENUS = "menus"
+USERS = "users"
+GROUPS = "groups"
+PURPOSES = "purposes"
+
+BUMPED_KEY = "pyracms.cache_bumped"
+
+# Generations last read from the cache_generation table, shared by the
+# whole process. "polled" is when the table was last read.
+_state = {"interval": 1.0, "polled": 0, "generations": {}}
+_lock = Lock()
+_cached_values = WeakSet()
+# Models of the ReferenceCaches, with the cache their writes bump
+_reference_models = {}
+
+def configure(settings):
+    """
+    Read cache_poll_interval (milliseconds) from the application settings
+    """
+    interval = settings.get("cache_poll_interval")
+    if interval:
+        _state["interval"] = int(interval) / 1000.0
+
+def reset():
+    """
+    Forget all generations and cached values held by this process
+    """
+    with _lock:
+        _state["polled"] = 0
+        _state["generations"] = {}
+    for cached in list(_cached_values):
+        cached.clear()
+
+def bump(name, session=None):
+    """
+    Bump the generation of a cache. The cache_generation row is updated
+    in the same transaction as the write, just before it commits.
+    """
+    session = session or DBSession
+    if isinstance(session, scoped_session):
+        session = session()
+    session.info.setdefault(BUMPED_KEY, set()).add(name)
+    mark_changed(session)
+
+def is_bumped(name, session=None):
+    """
+    Check if the current transaction has bumped a cache, if so it must
+    not trust the process wide copy.
+    """
+    session = session or DBSession
+    return name in session.info.get(BUMPED_KEY, ())
+
+def poll(session=None):
+    """
+    Read all the generations in one query
+    """
+    session = session or DBSession
+    generations = dict(session.query(CacheGeneration.name,
+                                     CacheGeneration.generation))
+    with _lock:
+        _state["generations"] = generations
+        _state["polled"] = time()
+    return generations
+
+def generation(name, session=None):
+    """
+    Get the generation of a cache. The table is polled at most once
+    every cache_poll_interval.
+    """
+    generations = _state["generations"]
+    if time() - _state["polled"] >= _state["interval"]:
+        generations = poll(session)
+    return generations.get(name, 0)
+
+def read_generations(names, session=None):
+    """
+    Read the generations of names as the transaction of session sees
+    them, the polled copy is left alone
+    """
+    session = session or DBSession
+    generations = dict(session.query(
+        CacheGeneration.name, CacheGeneration.generation).filter(
+        CacheGeneration.name.in_(names)))
+    return tuple(generations.get(name, 0) for name in names)
+
+@event.listens_for(Session, "before_commit")
+def _cache_before_commit(session):
+    for name in sorted(session.info.get(BUMPED_KEY, ())):
+        updated = session.query(CacheGeneration).filter_by(
+            name=name).update({CacheGeneration.generation:
+                               CacheGeneration.generation + 1},
+                              synchronize_session=False)
+        if not updated:
+            session.add(CacheGeneration(name, 1))
+
+@event.listens_for(Session, "before_flush")
+def _cache_before_flush(session, flush_context, instances):
+    if not _reference_models:
+        return
+    for obj in chain(session.new, session.deleted, session.dirty):
+        name = _reference_models.get(type(obj))
+        if name is None or is_bumped(name, session):
+            continue
+        if obj in session.dirty and not session.is_modified(
+                obj, include_collections=False):
+            continue
+        bump(name, session)
+
+@event.listens_for(Session, "after_commit")
+def _cache_after_commit(session):
+    if session.info.get(BUMPED_KEY):
+        # Our own writes should be visible straight away
+        _state["polled"] = 0
+
+@event.listens_for(Session, "after_transaction_end")
+def _cache_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(BUMPED_KEY, None)
+
+class CachedValue():
+    """
+    A value shared by the whole process, built by loader(session) and
+    rebuilt when the generation of any of the named caches changes.
+    """
+    def __init__(self, loader, *names):
+        self.loader = loader
+        self.names = names
+        self.entry = (None, None)
+        _cached_values.add(self)
+
+    def get(self, session=None):
+        session = session or DBSession
+        for name in self.names:
+            if is_bumped(name, session):
+                return self.loader(session)
+        generations = tuple(generation(name, session) for name in self.names)
+        cached_generations, value = self.entry
+        if cached_generations == generations:
+            return value
+        # The poll can be ahead of what this transaction sees, keep the
+        # value under the generations it is loaded with
+        generations = read_generations(self.names, session)
+        if cached_generations == generations:
+            return value
+        value = self.loader(session)
+        self.entry = (generations, value)
+        return value
+
+    def clear(self):
+        self.entry = (None, None)
+
+class ReferenceCache():
+    """
+    Rows of a small, rarely changed table by name, all loaded in one
+    query and reloaded when the generation of the named cache changes.
+    Rows are kept as immutable named tuples. Flushing a new, changed or
+    deleted row bumps the cache, bulk query updates must bump it.
+    """
+    def __init__(self, model, name, key="name"):
+        self.model = model
+        self.key = key
+        self.columns = [x.key for x in inspect(model).column_attrs]
+        self.row = namedtuple(model.__name__ + "Row", self.columns)
+        self.cached = CachedValue(self.load, name)
+        _reference_models[model] = name
+
+    def load(self, session):
+        query = session.query(*[getattr(self.model, x) for x in self.columns])
+        return dict((getattr(row, self.key), self.row(*row)) for row in query)
+
+    def snapshot(self, name, session=None):
+        """
+        Get the row named name, raises KeyError if there is none
+        """
+        return self.cached.get(session)[name]
+
+    def id(self, name, session=None):
+        return self.snapshot(name, session).id
+
+    def get(self, name, session=None):
+        """
+        Get the row named name as a model object in the session, without
+        a query. The session's own instance is returned if it has one.
+        Raises KeyError if there is none.
+        """
+        session = session or DBSession
+        if isinstance(session, scoped_session):
+            session = session()
+        row = self.snapshot(name, session)
+        mapper = inspect(self.model)
+        # Keep an instance already loaded, and any unflushed changes to it
+        key = mapper.identity_key_from_primary_key(
+            [getattr(row, x.key) for x in mapper.primary_key])
+        obj = session.identity_map.get(key)
+        if obj is not None:
+            return obj
+        obj = mapper.class_manager.new_instance()
+        for column, value in zip(self.columns, row):
+            setattr(obj, column, value)
+        make_transient_to_detached(obj)
+        return session.merge(obj, load=False)
+
+class LRUCache():
+    """
+    A thread safe least recently used cache, entries optionally expire
+    after ttl seconds. Counts hits and misses.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        _cached_values.add(self)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time() + self.ttl
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.data), "maxsize": self.maxsize}
@@ -1,22 +1,119 @@
 from datetime import datetime
 
 from pyramid.path import AssetResolver
-from pyracms.models import DBSession, Files, APIFileUpload
+from pyramid.settings import asbool
+from pyracms.models import DBSession, Files, FileBlob, APIFileUpload, MediaJob
+from hashlib import sha256
 from uuid import uuid1
-from os.path import join, splitext
-from os import mkdir
+from os.path import dirname, join, splitext
+from os import link, makedirs, mkdir, remove, replace
 from time import time
 from shutil import rmtree
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
+from threading import local
+import transaction
 
 resolve = AssetResolver().resolve
 
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+CHUNK_SIZE = 10**6
+# Bytes at the start of an upload its mimetype is guessed from
+SNIFF_SIZE = 1024
+
+# libmagic handles are not thread safe, each thread keeps its own
+_magic = local()
+
 class APIFileNotFound(Exception):
     pass
 
+def sniff_mimetype(buf):
+    """
+    Guess the mimetype of a file from its first bytes
+    """
+    handle = getattr(_magic, "handle", None)
+    if handle is None:
+        import magic
+        handle = _magic.handle = magic.Magic(mime=True)
+    return handle.from_buffer(buf[:SNIFF_SIZE])
+
+def static_path(settings):
+    return resolve(settings.get("static_path")).abspath()
+
+def _ref_blob(digest):
+    # Returns the number of blobs updated, 0 if digest is not stored
+    return DBSession.query(FileBlob).filter_by(digest=digest).update(
+        {FileBlob.refcount: FileBlob.refcount + 1},
+        synchronize_session=False)
+
+def _remove_blob(success, path):
+    # A rolled back delete still needs the blob
+    if not success:
+        return
+    try:
+        remove(path)
+    except OSError:
+        pass
+
+def open_media(filename):
+    from PIL import Image
+    is_image = False
+    is_video = False
+    media_obj = None
+    try:
+        media_obj = Image.open(filename)
+        is_image = True
+    except OSError:
+        is_image = False
+        try:
+            from moviepy.video.io.VideoFileClip import VideoFileClip
+            media_obj = VideoFileClip(filename)
+            is_video = True
+        except OSError:
+            pass
+        except AttributeError:
+            pass
+    return (is_image, is_video, media_obj)
+
+def make_thumbnail(filename, thumbnail_size=(256, 256)):
+    """
+    Save a png thumbnail next to filename, from a frame for videos.
+    Returns (is_picture, is_video, video_duration).
+    """
+    from PIL import Image
+    is_image, is_video, media_obj = open_media(filename)
+    str_file, ext = splitext(filename)
+    if is_image:
+        media_obj.thumbnail(thumbnail_size)
+        media_obj.save(str_file + ".thumbnail.png", "png")
+        return (True, False, 0)
+    if is_video:
+        main_path = str_file + ".main.png"
+        media_obj.save_frame(main_path, media_obj.duration/10)
+        im_obj = Image.open(main_path)
+        im_obj.thumbnail(thumbnail_size)
+        im_obj.save(str_file + ".thumbnail.png", "png")
+        return (False, True, media_obj.duration)
+    return (False, False, 0)
+
+def finish_thumbnail(f, is_picture, is_video, video_duration):
+    """
+    Record the result of make_thumbnail, only media counts as complete
+    """
+    f.is_picture = is_picture
+    f.is_video = is_video
+    if is_video:
+        f.video_duration = video_duration
+    f.upload_complete = is_picture or is_video
+
 class FileLib:
     UPLOAD_DIR = "uploads"
+    BLOB_DIR = "blobs"
 
     def __init__(self, request):
         self.request = request
@@ -30,33 +127,18 @@ class FileLib:
         return (uuid, join(uuid, filename))
 
     def get_static_path(self):
-        setting_data = self.request.registry.settings.get("static_path")
-        return resolve(setting_data).abspath()
+        return static_path(self.request.registry.settings)
 
     def open_media(self, filename):
-        from PIL import Image
-        is_image = False
-        is_video = False
-        media_obj = None
-        try:
-            media_obj = Image.open(filename)
-            is_image = True
-        except OSError:
-            is_image = False
-            try:
-                from moviepy.video.io.VideoFileClip import VideoFileClip
-                media_obj = VideoFileClip(filename)
-                is_video = True
-            except OSError:
-                pass
-            except AttributeError:
-                pass
-        return (is_image, is_video, media_obj)
-
-    def write(self, filename, file_obj, mimetype, thumbnail=False,
+        return open_media(filename)
+
+    def write(self, filename, file_obj, mimetype=None, thumbnail=False,
               thumbnail_size=(256, 256)):
         """
         Make a new File record.
+        The upload is read once, from where it is, its size, mimetype
+        when not given and digest for upload_dedup are worked out as it
+        is written.
         """
         filename = self.filename_filter(filename)
         uuid, new_filename = self.get_filename(filename)
@@ -64,10 +146,6 @@ class FileLib:
                               new_filename)
         f = Files(filename, mimetype)
         f.uuid = uuid
-        file_obj.seek(0,2)
-        f.size = file_obj.tell()
-        file_obj.seek(0)
-        DBSession.add(f)
         try:
             mkdir(join(self.get_static_path(), self.UPLOAD_DIR))
         except OSError:
@@ -76,40 +154,106 @@ class FileLib:
             mkdir(join(self.get_static_path(), self.UPLOAD_DIR, uuid))
         except OSError:
             pass
-        file_out_obj = open(name_with_path, "wb")
+        dedup = asbool(self.request.registry.settings.get("upload_dedup"))
+        out_path = name_with_path
+        if dedup:
+            out_path = join(self.get_static_path(), self.UPLOAD_DIR,
+                            self.BLOB_DIR, uuid + ".tmp")
+            makedirs(dirname(out_path), exist_ok=True)
+        digest = sha256()
+        size = 0
+        file_out_obj = open(out_path, "wb")
         while True:
-            buf = file_obj.read(10**6)
+            buf = file_obj.read(CHUNK_SIZE)
+            if f.mimetype is None:
+                f.mimetype = sniff_mimetype(buf)
             if buf:
+                size += len(buf)
+                if dedup:
+                    digest.update(buf)
                 file_out_obj.write(buf)
             else:
                 break
         file_out_obj.close()
-        if thumbnail:
-            from PIL import Image
-            is_image, is_video, media_obj = self.open_media(name_with_path)
-            str_file, ext = splitext(name_with_path)
-            if is_image:
-                media_obj.thumbnail(thumbnail_size)
-                media_obj.save(str_file + ".thumbnail.png", "png")
-                f.is_picture = True
-            if is_video:
-                main_path = str_file + ".main.png"
-                media_obj.save_frame(main_path, media_obj.duration/10)
-                im_obj = Image.open(main_path)
-                im_obj.thumbnail(thumbnail_size)
-                im_obj.save(str_file + ".thumbnail.png", "png")
-                f.is_video = True
-                f.video_duration = media_obj.duration
-            if not is_image and not is_video:
-                return f
-        f.upload_complete = True
+        f.size = size
+        DBSession.add(f)
+        if dedup:
+            f.blob = self.store_blob(out_path, digest.hexdigest(), f.size,
+                                     name_with_path)
+        if not thumbnail:
+            f.upload_complete = True
+        elif asbool(self.request.registry.settings.get("media_queue")):
+            # Thumbnailed by media_pyracms_worker once committed
+            DBSession.add(MediaJob(f, thumbnail_size))
+        else:
+            finish_thumbnail(f, *make_thumbnail(name_with_path,
+                                                thumbnail_size))
         return f
 
+    def blob_path(self, digest):
+        return join(self.get_static_path(), self.UPLOAD_DIR, self.BLOB_DIR,
+                    digest[:2], digest)
+
+    def store_blob(self, tmp_path, digest, size, name_with_path):
+        """
+        Keep the file in tmp_path as the blob of digest, unless it is
+        stored already, and hard link it to name_with_path.
+        Returns the FileBlob, its refcount counting this new file.
+        """
+        DBSession.flush()
+        if not _ref_blob(digest):
+            try:
+                with DBSession.begin_nested():
+                    blob = FileBlob(digest, size)
+                    blob.refcount = 1
+                    DBSession.add(blob)
+            except IntegrityError:
+                # Stored by a concurrent upload meanwhile
+                _ref_blob(digest)
+        blob = DBSession.query(FileBlob).filter_by(
+            digest=digest).populate_existing().one()
+        path = self.blob_path(digest)
+        try:
+            link(path, name_with_path)
+        except FileNotFoundError:
+            makedirs(dirname(path), exist_ok=True)
+            replace(tmp_path, path)
+            link(path, name_with_path)
+        else:
+            remove(tmp_path)
+        return blob
+
+    def release_blob(self, db_file):
+        """
+        Drop the reference of a file to its blob, the blob is removed
+        once no file uses it and the transaction commits.
+        """
+        blob = db_file.blob
+        if blob is None:
+            return
+        DBSession.query(FileBlob).filter_by(id=blob.id).update(
+            {FileBlob.refcount: FileBlob.refcount - 1},
+            synchronize_session=False)
+        DBSession.refresh(blob)
+        if blob.refcount <= 0:
+            DBSession.delete(blob)
+            transaction.get().addAfterCommitHook(
+                _remove_blob, args=(self.blob_path(blob.digest),))
+
+    def job_status(self, db_file):
+        """
+        Status of the thumbnailing job of a file, None if it has none
+        """
+        if db_file.media_job is None:
+            return None
+        return db_file.media_job.status
+
     def delete(self, db_file):
         DBSession.flush()
         path = join(self.get_static_path(), self.UPLOAD_DIR, 
                     db_file.uuid)
         rmtree(path, True)
+        self.release_blob(db_file)
         DBSession.delete(db_file)
 
     def api_show(self, api_uuid):
@@ -125,12 +269,12 @@ class FileLib:
             raise APIFileNotFound
         return file_obj
 
-    def api_write(self, filename, file_obj, mimetype):
+    def api_write(self, filename, file_obj, mimetype=None):
         """
         Upload a file using Pyracms API
         :param filename: Filename from uploaded file
         :param file_obj: Standard Python File object from uploaded file
-        :param mimetype: Uploaded files mimetype
+        :param mimetype: Uploaded files mimetype, guessed when None
         :return: APIFileUpload object
         """
         f = self.write(filename, file_obj, mimetype, True)
@@ -145,6 +289,7 @@ class FileLib:
         path = join(self.get_static_path(), self.UPLOAD_DIR,
                     api_obj.file_obj.uuid)
         rmtree(path, True)
+        self.release_blob(api_obj.file_obj)
         DBSession.delete(api_obj)
 
     def api_delete_expired(self):
@@ -0,0 +1,234 @@
+from .searchlib import (SearchPage, FIELD_BOOSTS, FACET_FIELDS, LOCK_TIMEOUT,
+                        COMPLETE_FIELDS, count_facets, parse_sort)
+from collections import Counter
+from datetime import datetime
+from threading import local
+from whoosh.analysis import STOP_WORDS
+import html
+import math
+import re
+import sqlite3
+
+# Columns of the full text index, in the order bm25() takes their weights
+COLUMNS = ("title", "tags", "content", "item_id")
+STORED = ("title", "path", "content", "tags", "what", "created", "username",
+          "item_id")
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY, item_id TEXT UNIQUE, path TEXT, title TEXT,
+    tags TEXT, content TEXT, what TEXT, created TEXT, username TEXT);
+CREATE INDEX IF NOT EXISTS ix_search_docs_path ON search_docs (path);
+CREATE INDEX IF NOT EXISTS ix_search_docs_what ON search_docs (what);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    title, tags, content, item_id, content='search_docs',
+    content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS search_docs_insert AFTER INSERT ON search_docs
+BEGIN
+    INSERT INTO search_fts (rowid, title, tags, content, item_id)
+    VALUES (new.id, new.title, new.tags, new.content, new.item_id);
+END;
+CREATE TRIGGER IF NOT EXISTS search_docs_delete AFTER DELETE ON search_docs
+BEGIN
+    INSERT INTO search_fts (search_fts, rowid, title, tags, content, item_id)
+    VALUES ('delete', old.id, old.title, old.tags, old.content, old.item_id);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS search_vocab USING fts5vocab(
+    search_fts, 'col');
+CREATE TABLE IF NOT EXISTS search_generation (
+    id INTEGER PRIMARY KEY, generation INTEGER NOT NULL);
+INSERT OR IGNORE INTO search_generation VALUES (1, 0);
+"""
+
+FROM = """
+FROM search_fts JOIN search_docs ON search_docs.id = search_fts.rowid
+WHERE search_fts MATCH ? %s
+"""
+
+# snippet() does not escape the text, matches are marked with control
+# characters and turned into tags once the rest is escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+SEARCH = """
+SELECT %s, snippet(search_fts, 2, char(2), char(3), '...', 32)
+""" % ", ".join("search_docs.%s" % x for x in STORED) + FROM + """
+ORDER BY %s LIMIT ? OFFSET ?
+"""
+
+RANK = "bm25(search_fts, %s)" % ", ".join(str(FIELD_BOOSTS[x])
+                                         for x in COLUMNS)
+
+INSERT = "INSERT INTO search_docs (%s) VALUES (%s)" % (
+    ", ".join(STORED), ", ".join("?" for x in STORED))
+
+def highlights(snippet):
+    """
+    Escape a snippet and mark its matches up as the Whoosh backend does
+    """
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(
+        MATCH_START, '<b class="match term0">').replace(MATCH_END, '</b>')
+
+def to_match(user_input):
+    """
+    Turn user input into an FTS5 query matching all of its words.
+    Stop words are dropped, as Whoosh does.
+    """
+    words = [x for x in re.findall(r"\w+", user_input.lower())
+             if x not in STOP_WORDS]
+    return " ".join('"%s"' % x for x in words)
+
+class FTS5Backend():
+    """
+    Search backend keeping the index in an SQLite FTS5 table.
+    SQLite allows many readers alongside a writer, so several worker
+    processes can share one index file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+
+    def connection(self):
+        """
+        Get this thread's connection, creating the tables if needed
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def generation(self):
+        """
+        Changes whenever the index is committed to
+        """
+        return self.connection().execute(
+            "SELECT generation FROM search_generation").fetchone()[0]
+
+    def terms(self):
+        """
+        (word, document count) of COMPLETE_FIELDS
+        """
+        return self.connection().execute(
+            "SELECT term, doc FROM search_vocab WHERE col IN (%s)" %
+            ", ".join("?" for x in COMPLETE_FIELDS), COMPLETE_FIELDS)
+
+    def search_page(self, user_input, page, pagelen, what=None,
+                    filters=None, sortedby=None, facets=False):
+        """
+        Run a query over all fields at once, returns a SearchPage.
+        what limits the search to some content types, filters is a list
+        of (field, values) pairs a hit must match one value of, sortedby
+        a field name, "-" first to reverse it.
+        """
+        match = to_match(user_input)
+        if not match:
+            return SearchPage([], 1, 0, 0,
+                              count_facets([]) if facets else None)
+        conn = self.connection()
+        args = [match]
+        where = []
+        for field, values in [("what", what)] + list(filters or []):
+            if not values:
+                continue
+            if field == "tags":
+                # instr() as LIKE would treat % and _ as wildcards
+                where.append("(%s)" % " OR ".join(
+                    "instr(' ' || search_docs.tags || ' ', ?) > 0"
+                    for x in values))
+                args.extend(" %s " % x for x in values)
+            else:
+                where.append("search_docs.%s IN (%s)" % (
+                    field, ", ".join("?" for x in values)))
+                args.extend(values)
+        where = "".join(" AND " + x for x in where)
+        field, reverse = parse_sort(sortedby)
+        order = RANK
+        if field:
+            order = "search_docs.%s IS NULL, search_docs.%s %s" % (
+                field, field, "DESC" if reverse else "ASC")
+        total = conn.execute("SELECT count(*)" + FROM % where,
+                             args).fetchone()[0]
+        pagecount = int(math.ceil(total / float(pagelen)))
+        page = max(min(page, pagecount), 1)
+        hits = []
+        for row in conn.execute(SEARCH % (where, order),
+                                args + [pagelen, (page - 1) * pagelen]):
+            fields = dict(zip(STORED, row))
+            try:
+                fields["created"] = datetime.strptime(fields["created"],
+                                                      DATE_FORMAT)
+            except (TypeError, ValueError):
+                pass
+            fields["highlights"] = highlights(row[-1])
+            hits.append(fields)
+        counts = None
+        if facets:
+            counts = dict((x, Counter()) for x in FACET_FIELDS)
+            for row in conn.execute("SELECT %s" % ", ".join(
+                    "search_docs.%s" % x for x in FACET_FIELDS) +
+                    FROM % where, args):
+                for name, value in zip(FACET_FIELDS, row):
+                    if name == "tags":
+                        counts[name].update((value or "").split())
+                    elif value is not None:
+                        counts[name][value] += 1
+            counts = count_facets([counts])
+        return SearchPage(hits, page, pagecount, total, counts)
+
+    def _insert(self, conn, fields):
+        created = fields.get("created")
+        if isinstance(created, datetime):
+            fields = dict(fields, created=created.strftime(DATE_FORMAT))
+        conn.execute("DELETE FROM search_docs WHERE item_id = ?",
+                     (fields["item_id"],))
+        conn.execute(INSERT, [fields.get(x) for x in STORED])
+
+    def write_batch(self, deletes, updates):
+        """
+        Delete paths then update documents, with a single commit
+        """
+        conn = self.connection()
+        with conn:
+            for path in deletes:
+                conn.execute("DELETE FROM search_docs WHERE path = ?", (path,))
+            for fields in updates:
+                self._insert(conn, fields)
+            conn.execute("UPDATE search_generation "
+                         "SET generation = generation + 1")
+
+    def rebuild(self, docs, what=None):
+        """
+        Replace the whole index, or the documents of one content type, in
+        one transaction. Searches see the old index until it commits.
+        Returns the number of documents.
+        """
+        conn = self.connection()
+        count = 0
+        with conn:
+            if what:
+                conn.execute("DELETE FROM search_docs WHERE what = ?",
+                             (what,))
+            else:
+                conn.execute("DELETE FROM search_docs")
+            for fields in docs:
+                if what and fields.get("what") != what:
+                    continue
+                self._insert(conn, fields)
+                count += 1
+            conn.execute("UPDATE search_generation "
+                         "SET generation = generation + 1")
+        return count
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
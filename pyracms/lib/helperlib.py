@@ -4,8 +4,12 @@ from deform.form import Form
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import authenticated_userid, Everyone
 from pyramid.url import route_url
+from .cachelib import LRUCache
 import inspect
 
+# (registry, route name, arguments) -> path, see cached_route_url
+_route_paths = LRUCache(maxsize=10000)
+
 def is_int(data):
     try:
         int(data)
@@ -44,6 +48,21 @@ def redirect(request, route_id, **optargs):
     else:
         return HTTPFound(location=route_url(route_id, request, **optargs))
 
+def cached_route_url(request, route_name, **kw):
+    """
+    Same as request.route_url, but the path is cached per route name and
+    arguments. The application url is added at the end.
+    """
+    key = (id(request.registry), route_name, tuple(sorted(kw.items())))
+    try:
+        path = _route_paths.get(key)
+    except TypeError:
+        return request.route_url(route_name, **kw)
+    if path is None:
+        path = request.route_url(route_name, _app_url='', **kw)
+        _route_paths.set(key, path)
+    return request.application_url + path
+
 def get_username(request):
     """
     Get the username, otherwise return Everyone
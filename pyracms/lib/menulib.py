@@ -1,12 +1,71 @@
 from ..models import DBSession, MenuGroup, Menu
-from sqlalchemy.orm.exc import NoResultFound
-from json import dumps
+from .cachelib import CachedValue, ReferenceCache, MENUS, bump
+from collections import namedtuple
+from sqlalchemy.orm import joinedload
+from json import dumps, loads
 from pyracms.lib.helperlib import serialize_relation
+import logging
+
+log = logging.getLogger(__name__)
 
 
 class MenuGroupNotFound(Exception):
     pass
 
+class InvalidRouteJson(Exception):
+    pass
+
+CompiledMenuItem = namedtuple("CompiledMenuItem", ["id", "name", "type",
+                                                   "url", "route_name",
+                                                   "route_args",
+                                                   "permissions", "position"])
+
+def parse_route_json(route_json):
+    """
+    Validate route arguments, given as a dictionary or a JSON string.
+    Raise InvalidRouteJson if they are not a JSON object.
+    :return: Dictionary of route arguments
+    """
+    if isinstance(route_json, str):
+        try:
+            route_json = loads(route_json or "{}")
+        except ValueError:
+            raise InvalidRouteJson(route_json)
+    if not isinstance(route_json, dict):
+        raise InvalidRouteJson(route_json)
+    return route_json
+
+def compile_item(item):
+    """
+    Parse a menu item into a CompiledMenuItem
+    """
+    try:
+        route_args = parse_route_json(item.route_json)
+    except InvalidRouteJson:
+        # Only items saved before route_json was validated
+        log.warning("Menu item %s has invalid route_json %r, ignored",
+                    item.id, item.route_json)
+        route_args = {}
+    permissions = ()
+    if item.permissions:
+        permissions = tuple(item.permissions.split(","))
+    return CompiledMenuItem(item.id, item.name, item.type, item.url,
+                            item.route_name, route_args, permissions,
+                            item.position)
+
+def load_menus(session):
+    groups = session.query(MenuGroup).options(
+        joinedload(MenuGroup.menu_items))
+    return {group.name: tuple(compile_item(item)
+                              for item in group.menu_items)
+            for group in groups}
+
+# Process-wide copy of every menu group, already parsed
+_menus = CachedValue(load_menus, MENUS)
+
+# Menu group rows by name
+_groups = ReferenceCache(MenuGroup, MENUS)
+
 class MenuLib():
     """
     A library to manage menus
@@ -17,10 +76,31 @@ class MenuLib():
         Get menu group database object, filtered by name
         """
         try:
-            return DBSession.query(MenuGroup).filter_by(name=name).one()
-        except NoResultFound:
+            return _groups.get(name)
+        except KeyError:
             raise MenuGroupNotFound(name)
         
+    def show_groups(self, names=None):
+        """
+        Get menu group database objects and their items in one query.
+        :param names: List of menu group names, None for all of them
+        :return: Dictionary of menu group name to MenuGroup
+        """
+        query = DBSession.query(MenuGroup).options(
+            joinedload(MenuGroup.menu_items))
+        if names is not None:
+            query = query.filter(MenuGroup.name.in_(names))
+        return {group.name: group for group in query}
+
+    def compiled_group(self, name):
+        """
+        Get a tuple of CompiledMenuItem for a menu group, filtered by name
+        """
+        try:
+            return _menus.get()[name]
+        except KeyError:
+            raise MenuGroupNotFound(name)
+
     def list_groups(self):
         """
         List menu groups
@@ -31,6 +111,7 @@ class MenuLib():
         """
         Add menu grop
         """
+        bump(MENUS)
         group = MenuGroup(name)
         DBSession.add(group)
         return group
@@ -39,8 +120,21 @@ class MenuLib():
         """
         Delete menu group by name
         """
+        bump(MENUS)
         DBSession.delete(self.show_group(name))
 
+    def update_items(self, group, items):
+        """
+        Replace the menu items of a group
+        :param group: Menu Group to update
+        :param items: List of Menu objects
+        """
+        bump(MENUS)
+        for item in items:
+            item.route_json = dumps(parse_route_json(item.route_json),
+                                    sort_keys=True)
+        group.menu_items = items
+
     def add_menu_item_url(self, name, url, position, group, permissions=''):
         """
         Add a menu item with a custom url
@@ -51,6 +145,7 @@ class MenuLib():
         :param permissions: Permissions for the item
         :return:
         """
+        bump(MENUS)
         item = Menu(name, "url", position, group, permissions)
         item.url = url
         DBSession.add(item)
@@ -65,22 +160,31 @@ class MenuLib():
         :param position: Position in list
         :param group: Menu Group it belongs to
         :param permissions: Permissions for the item
+        :param route_json: Dictionary or JSON string of route arguments
         :return:
         """
+        route_json = dumps(parse_route_json(route_json), sort_keys=True)
+        bump(MENUS)
         item = Menu(name, "route", position, group, permissions)
         item.route_name = route_name
-        item.route_json = dumps(route_json)
+        item.route_json = route_json
         DBSession.add(item)
         return item
 
     def to_dict(self):
         output = {}
-        groups = self.list_groups()
+        groups = self.show_groups().values()
         for item in groups:
             output[item.name] = serialize_relation(item.menu_items)
         return output
 
     def from_dict(self, data):
+        route_json = {}
+        for k, v in data.items():
+            for i, item in enumerate(v):
+                route_json[k, i] = dumps(parse_route_json(item["route_json"]),
+                                         sort_keys=True)
+        bump(MENUS)
         DBSession.query(MenuGroup).delete()
         DBSession.query(Menu).delete()
         for k, v in data.items():
@@ -89,11 +193,11 @@ class MenuLib():
             except MenuGroupNotFound:
                 group = MenuGroup(k)
                 DBSession.add(group)
-            for item in v:
+            for i, item in enumerate(v):
                 m = Menu(item["name"], item["type"], item["position"],
                          group, item["permissions"])
                 m.route_name = item["route_name"]
-                m.route_json = item["route_json"]
+                m.route_json = route_json[k, i]
                 m.url = item["url"]
                 DBSession.add(m)
                 group.menu_items.append(m)
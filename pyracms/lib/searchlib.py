@@ -1,55 +1,660 @@
+from .cachelib import LRUCache
 from whoosh.fields import ID, Schema, TEXT, DATETIME, KEYWORD
+from whoosh.highlight import ContextFragmenter, HtmlFormatter, highlight
 from whoosh.index import create_in, open_dir, exists_in
-from whoosh.qparser import QueryParser
+from whoosh.index import LockError
+from whoosh.qparser import MultifieldParser
+from whoosh.query import And, NullQuery, Or, Term
+from whoosh.sorting import Count, FieldFacet
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Lock, Thread, local
+import atexit
+import heapq
+import logging
+import math
 import os
+import re
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
 
 INDEX_NAME = 'whoosh_index'
 schema = Schema(title=TEXT(stored=True), path=ID(stored=True), 
                 content=TEXT(stored=True), tags=KEYWORD(stored=True), 
-                what=ID(stored=True), created=DATETIME(stored=True), 
-                username=ID(stored=True), item_id=ID(stored=True, unique=True))
+                what=ID(stored=True, sortable=True),
+                created=DATETIME(stored=True, sortable=True),
+                username=ID(stored=True, sortable=True),
+                item_id=ID(stored=True, unique=True))
 
-class SearchLib():
-    def __init__(self):
-        self.ix = None
-        if not exists_in(INDEX_NAME):
+# Fields searched by default and how much a match in each one counts
+FIELD_BOOSTS = {"title": 3.0, "tags": 2.0, "content": 1.0, "item_id": 1.0}
+PAGELEN = 10
+MAX_PAGELEN = 50
+
+# Fields results can be narrowed by, ordered by and counted by
+FILTER_FIELDS = ("tags", "username")
+SORT_FIELDS = ("created", "username", "what")
+FACET_FIELDS = ("what", "tags", "username")
+
+# Fields whose words the search box completes
+COMPLETE_FIELDS = ("title", "tags")
+COMPLETE_LIMIT = 10
+MAX_COMPLETE_LIMIT = 50
+
+# Which backend stores the index, see configure()
+BACKENDS = ("whoosh", "fts5")
+_backend = {"name": "whoosh", "fts5_path": "search_index.sqlite",
+            "instance": None}
+_backend_lock = Lock()
+
+# Each content type (the "what" field) has its own sub-index in INDEX_NAME,
+# MAIN holds anything indexed before the index was split.
+MAIN = "MAIN"
+SEARCH_THREADS = 4
+
+# Sub-indexes are opened once per process, searchers once per thread.
+# Whoosh searchers must not be shared between threads.
+_index = {"indexes": {}, "path": None}
+_index_lock = Lock()
+_searchers = local()
+_pool = {"executor": None, "pid": None}
+
+# (query, page, pagelen, content types, filters, sort, index generation)
+# -> SearchPage
+_results = LRUCache(maxsize=1000)
+# (query, content types, filters, index generation) -> facet counts
+_facets = LRUCache(maxsize=1000)
+# Completions for the current index generation, see SearchLib.complete
+_completions = {"value": None}
+
+# Index writes are queued and committed in batches by one writer thread
+# per process, so saving a page never waits on the index.
+COMMIT_INTERVAL = 1.0
+BATCH_SIZE = 500
+LOCK_TIMEOUT = 5.0
+# Attempts at the write lock, waiting twice as long after each one
+LOCK_RETRIES = 10
+MAX_LOCK_WAIT = 60.0
+# Seconds an exiting process waits for its queued writes
+EXIT_TIMEOUT = 30.0
+_writes = Queue()
+_writer = {"thread": None, "pid": None}
+
+def configure(settings):
+    """
+    Read search_backend (whoosh or fts5) and search_fts5_path from the
+    application settings
+    """
+    name = settings.get("search_backend", "whoosh")
+    if name not in BACKENDS:
+        raise ValueError("Unknown search_backend %s" % name)
+    with _backend_lock:
+        _backend["name"] = name
+        _backend["fts5_path"] = settings.get("search_fts5_path",
+                                             _backend["fts5_path"])
+        _backend["instance"] = None
+        _completions["value"] = None
+    _results.clear()
+    _facets.clear()
+
+def get_backend():
+    """
+    Get the configured search backend, shared by the whole process
+    """
+    with _backend_lock:
+        if _backend["instance"] is None:
+            if _backend["name"] == "fts5":
+                from .fts5lib import FTS5Backend
+                _backend["instance"] = FTS5Backend(_backend["fts5_path"])
+            else:
+                _backend["instance"] = WhooshBackend()
+        return _backend["instance"]
+
+def index_name(what):
+    """
+    Name of the sub-index holding a content type
+    """
+    if what and re.match(r"^\w+$", what):
+        return what
+    return MAIN
+
+def index_generations(path=INDEX_NAME):
+    """
+    Latest generation of each sub-index found in path
+    """
+    try:
+        files = os.listdir(path)
+    except OSError:
+        return {}
+    generations = {}
+    for match in map(re.compile(r"^_(\w+)_(\d+)\.toc$").match, files):
+        if match:
+            name, generation = match.group(1), int(match.group(2))
+            generations[name] = max(generation, generations.get(name, 0))
+    return generations
+
+def index_names(path=INDEX_NAME):
+    """
+    Names of the sub-indexes found in path
+    """
+    return sorted(index_generations(path))
+
+def get_index(name=MAIN, create=True):
+    """
+    Open (or create) a sub-index, shared by the whole process.
+    Returns None if it does not exist and create is False.
+    Reopened when a rebuilt index has been swapped in, see
+    pyracms.scripts.reindex.
+    """
+    with _index_lock:
+        path = os.path.realpath(INDEX_NAME)
+        indexes = _index["indexes"]
+        if _index["path"] != path:
+            for ix in indexes.values():
+                ix.close()
+            indexes.clear()
+            _index["path"] = path
+            _results.clear()
+            _facets.clear()
+        if name not in indexes:
+            if exists_in(INDEX_NAME, indexname=name):
+                indexes[name] = open_dir(INDEX_NAME, indexname=name)
+            elif create:
+                try:
+                    os.mkdir(INDEX_NAME)
+                except:
+                    pass
+                indexes[name] = create_in(INDEX_NAME, schema, indexname=name)
+            else:
+                return None
+        return indexes[name]
+
+def get_pool():
+    """
+    Thread pool searching the sub-indexes in parallel
+    """
+    with _index_lock:
+        if _pool["executor"] is None or _pool["pid"] != os.getpid():
+            _pool["executor"] = ThreadPoolExecutor(SEARCH_THREADS)
+            _pool["pid"] = os.getpid()
+        return _pool["executor"]
+
+def close_index():
+    """
+    Close this thread's searcher and forget the shared index.
+    Queued writes are committed first.
+    """
+    flush()
+    get_backend().close()
+
+def queue_write(operation, *args):
+    """
+    Queue an index write, starting the writer thread if needed
+    """
+    with _index_lock:
+        thread = _writer["thread"]
+        if (thread is None or not thread.is_alive() or
+                _writer["pid"] != os.getpid()):
+            thread = Thread(target=_write_loop, name="pyracms-search-writer")
+            thread.daemon = True
+            thread.start()
+            _writer["thread"] = thread
+            _writer["pid"] = os.getpid()
+    _writes.put((operation, args))
+
+def flush(timeout=None):
+    """
+    Commit queued index writes now and block until they are done, or
+    for at most timeout seconds. Returns False if writes are left.
+    """
+    thread = _writer["thread"]
+    if (thread is None or not thread.is_alive() or
+            _writer["pid"] != os.getpid()):
+        return True
+    _writes.put(("flush", ()))
+    with _writes.all_tasks_done:
+        return _writes.all_tasks_done.wait_for(
+            lambda: not _writes.unfinished_tasks, timeout)
+
+@atexit.register
+def _flush_at_exit():
+    # Writes still queued when the process exits would be lost
+    if not flush(EXIT_TIMEOUT):
+        log.warning("Search index writes lost at exit, the index is locked")
+
+def _is_locked(error):
+    return (isinstance(error, LockError) or
+            (isinstance(error, sqlite3.OperationalError) and
+             "locked" in str(error)))
+
+def _write_loop():
+    # Writes that found the index locked, by a rebuild most likely. They
+    # stay unfinished, so flush() waits, and are retried before newer
+    # writes so the last write to a path still wins.
+    held = []
+    while True:
+        try:
+            batch = [_writes.get(timeout=COMMIT_INTERVAL if held else None)]
+        except Empty:
+            batch = []
+        deadline = time.time() + COMMIT_INTERVAL
+        while (batch and len(batch) < BATCH_SIZE and
+               batch[-1][0] != "flush"):
             try:
-                os.mkdir(INDEX_NAME)
-            except:
-                pass
-            self.ix = create_in(INDEX_NAME, schema)
-        else:
-            self.ix = open_dir(INDEX_NAME)
-    
-    def search(self, user_input):
+                batch.append(_writes.get(timeout=max(deadline - time.time(),
+                                                     0)))
+            except Empty:
+                break
+        batch = held + batch
+        try:
+            _write_batch(batch)
+        except Exception as e:
+            if _is_locked(e):
+                log.warning("Search index is locked, %d writes held back",
+                            len(batch))
+                held = batch
+                continue
+            log.exception("Search index update failed")
+        held = []
+        for i in range(len(batch)):
+            _writes.task_done()
+
+def _coalesce(batch):
+    """
+    Keep only the last write for each path. A writer can not delete
+    documents it has added itself, so deletes are returned separately
+    and must be applied first.
+    """
+    deletes = OrderedDict()
+    updates = OrderedDict()
+    for operation, args in batch:
+        if operation == "update":
+            updates[args[0]["path"]] = args[0]
+        elif operation == "delete":
+            updates.pop(args[0], None)
+            deletes[args[0]] = True
+    return list(deletes), list(updates.values())
+
+def _write_batch(batch):
+    """
+    Apply a batch of queued writes with a single commit
+    """
+    deletes, updates = _coalesce(batch)
+    if not deletes and not updates:
+        return
+    backend = get_backend()
+    backend.write_batch(deletes, updates)
+    _results.clear()
+    _facets.clear()
+    if _completions["value"] is not None:
+        # Rebuild here rather than on the next keystroke
+        generation = backend.generation()
+        _completions["value"] = Completions(backend.terms(), generation)
+
+def parse_sort(sortedby):
+    """
+    Turn "field" or "-field" into (field, reverse).
+    Returns (None, False) to order by score.
+    """
+    if not sortedby:
+        return None, False
+    field = sortedby.lstrip("-")
+    if field not in SORT_FIELDS:
+        raise ValueError("Can not sort by %s" % sortedby)
+    return field, sortedby.startswith("-")
+
+def sort_hits(hits, field, reverse):
+    """
+    Order (score, fields) pairs from several sub-indexes by score, or by
+    a stored field with empty values last
+    """
+    if field is None:
+        return sorted(hits, key=lambda hit: -hit[0])
+    present = [x for x in hits if x[1].get(field) is not None]
+    missing = [x for x in hits if x[1].get(field) is None]
+    return sorted(present, key=lambda hit: hit[1][field],
+                  reverse=reverse) + missing
+
+def count_facets(counters):
+    """
+    Add up facet counts, most common values first.
+    Documents without a value are not counted.
+    """
+    total = dict((x, Counter()) for x in FACET_FIELDS)
+    for counts in counters:
+        for field, values in counts.items():
+            total[field].update(
+                dict((k, v) for k, v in values.items() if k))
+    return dict((field, values.most_common())
+                for field, values in total.items())
+
+class Completions():
+    """
+    Sorted words of COMPLETE_FIELDS with the number of documents using
+    them, looked up by bisecting. The best completions of one and two
+    letter prefixes, which match the most words, are worked out up front.
+    """
+    def __init__(self, terms, generation):
+        self.generation = generation
+        counts = Counter()
+        for term, count in terms:
+            counts[term.lower()] += count
+        self.counts = counts
+        self.terms = sorted(counts)
+        short = {}
+        for term in self.terms:
+            for size in (1, 2):
+                if len(term) >= size:
+                    short.setdefault(term[:size], []).append(term)
+        self.short = dict((prefix, self.best(terms, MAX_COMPLETE_LIMIT))
+                          for prefix, terms in short.items())
+
+    def best(self, terms, limit):
+        return heapq.nlargest(limit, terms, key=self.counts.get)
+
+    def complete(self, prefix, limit=COMPLETE_LIMIT):
         """
-        Execute a search query
+        The most used words starting with prefix
         """
-        if not user_input:
+        prefix = prefix.strip().lower()
+        if not prefix:
             return []
-        s = self.ix.searcher()
-        items = ["title", "tags", "item_id"]
-        results = s.search(QueryParser("content", schema).parse(user_input))
-        for item in items:
-            results.extend(s.search(QueryParser(item, 
-                                                schema).parse(user_input)))
+        if len(prefix) <= 2:
+            return self.short.get(prefix, [])[:limit]
+        start = bisect_left(self.terms, prefix)
+        end = bisect_right(self.terms, prefix + chr(0x10ffff), start)
+        return self.best(self.terms[start:end], limit)
+
+class SearchPage():
+    """
+    A page of search results holding only stored fields and highlights,
+    so it can be cached and shared between threads.
+    """
+    def __init__(self, hits, pagenum, pagecount, total, facets=None):
+        self.hits = hits
+        self.pagenum = pagenum
+        self.pagecount = pagecount
+        self.total = total
+        # field -> [(value, count)] over every match, not just this page
+        self.facets = facets
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __getitem__(self, i):
+        return self.hits[i]
+
+    def __len__(self):
+        return len(self.hits)
+
+class WhooshBackend():
+    """
+    Search backend keeping one Whoosh index per content type in the
+    INDEX_NAME directory.
+    Every backend provides search_page, write_batch, generation and close.
+    """
+    def index(self, name=MAIN, create=True):
+        return get_index(name, create)
+
+    def searcher(self, name=MAIN):
+        """
+        Get this thread's long lived searcher for a sub-index. It is only
+        reopened when the index has changed, refresh() closes the old one.
+        """
+        ix = self.index(name)
+        searchers = getattr(_searchers, "searchers", None)
+        if searchers is None:
+            searchers = _searchers.searchers = {}
+        searcher = searchers.get(name)
+        if searcher is None or searcher._ix is not ix:
+            if searcher is not None:
+                searcher.close()
+            searcher = ix.searcher()
+        else:
+            searcher = searcher.refresh()
+        searchers[name] = searcher
+        return searcher
+
+    def generation(self):
+        """
+        Changes whenever any sub-index is committed to, or a rebuilt
+        index is swapped in
+        """
+        return (os.path.realpath(INDEX_NAME),
+                tuple(sorted(index_generations().items())))
+
+    def terms(self):
+        """
+        (word, document count) of COMPLETE_FIELDS in every sub-index
+        """
+        for name in index_names():
+            reader = self.searcher(name).reader()
+            for field in COMPLETE_FIELDS:
+                from_bytes = reader.schema[field].from_bytes
+                for text, info in reader.iter_field(field):
+                    yield from_bytes(text), info.doc_frequency()
+
+    def top(self, name, query, limit, filters=None, sortedby=None,
+            reverse=False, facets=False):
+        """
+        Search one sub-index, returns the number of matches, the
+        (score, stored fields) of the best limit hits and, if asked for,
+        the facet counts, all from a single pass.
+        """
+        args = {"limit": limit}
+        if filters:
+            args["filter"] = And([Or([Term(field, x) for x in values])
+                                  for field, values in filters])
+        if sortedby:
+            args["sortedby"] = sortedby
+            args["reverse"] = reverse
+        if facets:
+            args["groupedby"] = dict(
+                (x, FieldFacet(x, allow_overlap=x == "tags", maptype=Count))
+                for x in FACET_FIELDS)
+        results = self.searcher(name).search(query, **args)
+        counts = {}
+        if facets:
+            counts = dict((x, results.groups(x)) for x in FACET_FIELDS)
+        return (len(results), [(hit.score, hit.fields()) for hit in results],
+                counts)
+
+    def search_page(self, user_input, page, pagelen, what=None,
+                    filters=None, sortedby=None, facets=False):
+        """
+        Run a query over all fields at once, returns a SearchPage.
+        what limits the search to some content types, otherwise every
+        sub-index is searched in parallel and the hits merged.
+        filters is a list of (field, values) pairs a hit must match one
+        value of, sortedby a field name, "-" first to reverse it.
+        """
+        if what:
+            names = [index_name(x) for x in what]
+        else:
+            names = index_names()
+        names = [x for x in names if self.index(x, False) is not None]
+        if user_input:
+            parser = MultifieldParser(list(FIELD_BOOSTS), schema,
+                                      fieldboosts=FIELD_BOOSTS)
+            query = parser.parse(user_input)
+        else:
+            query = NullQuery
+        field, reverse = parse_sort(sortedby)
+        limit = page * pagelen
+        def top(name):
+            return self.top(name, query, limit, filters, field, reverse,
+                            facets)
+        if len(names) > 1:
+            found = list(get_pool().map(top, names))
+        else:
+            found = [top(x) for x in names]
+        total = sum(x[0] for x in found)
+        pagecount = int(math.ceil(total / float(pagelen)))
+        page = max(min(page, pagecount), 1)
+        merged = sort_hits([hit for x in found for hit in x[1]], field,
+                           reverse)
+        words = set(text for field, text in query.all_terms()
+                    if field == "content")
+        hits = []
+        for score, fields in merged[(page - 1) * pagelen:page * pagelen]:
+            fields["highlights"] = highlight(
+                fields.get("content") or "", words, schema["content"].analyzer,
+                ContextFragmenter(maxchars=200), HtmlFormatter(tagname="b"))
+            hits.append(fields)
+        return SearchPage(hits, page, pagecount, total,
+                          count_facets(x[2] for x in found) if facets else None)
+
+    def write_batch(self, deletes, updates):
+        """
+        Delete paths then update documents, with a single commit for
+        each sub-index that changes.
+        Retries while another process holds a write lock.
+        """
+        changes = OrderedDict()
+        for fields in updates:
+            name = index_name(fields.get("what"))
+            changes.setdefault(name, ([], []))[1].append(fields)
+        # Deleted paths and documents that changed type may be in any
+        # sub-index, only lock the ones that have them.
+        for name in index_names():
+            searcher = self.searcher(name)
+            terms = [('path', x) for x in deletes
+                     if searcher.document_number(path=x) is not None]
+            terms += [('item_id', x["item_id"]) for x in updates
+                      if index_name(x.get("what")) != name and
+                      searcher.document_number(item_id=x["item_id"])
+                      is not None]
+            if terms:
+                changes.setdefault(name, ([], []))[0].extend(terms)
+        for name, (terms, docs) in changes.items():
+            writer = self.writer(name)
+            try:
+                for field, value in terms:
+                    writer.delete_by_term(field, value)
+                for fields in docs:
+                    writer.update_document(**fields)
+            except Exception:
+                writer.cancel()
+                raise
+            writer.commit()
+
+    def writer(self, name):
+        """
+        Get a writer for a sub-index, waiting for the lock with back off.
+        Raises LockError after LOCK_RETRIES attempts.
+        """
+        wait = 1.0
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return self.index(name).writer(timeout=LOCK_TIMEOUT)
+            except LockError:
+                if attempt == LOCK_RETRIES - 1:
+                    raise
+                log.warning("Search index %s is locked, retrying in %.0f "
+                            "seconds", name, wait)
+                time.sleep(wait)
+                wait = min(wait * 2, MAX_LOCK_WAIT)
+
+    def close(self):
+        searchers = getattr(_searchers, "searchers", None) or {}
+        for searcher in searchers.values():
+            searcher.close()
+        _searchers.searchers = {}
+        with _index_lock:
+            for ix in _index["indexes"].values():
+                ix.close()
+            _index["indexes"].clear()
+
+class SearchLib():
+    def __init__(self):
+        self.backend = get_backend()
+
+    def search(self, user_input, page=1, pagelen=PAGELEN, what=None,
+               filters=None, sortedby=None):
+        """
+        Execute a search query over all fields at once.
+        what is a content type or a list of them to search, by default
+        all of them are.
+        filters maps a field in FILTER_FIELDS to a value or list of values,
+        sortedby is a field in SORT_FIELDS, "-" first to reverse it. Results
+        are ordered by score otherwise.
+        Returns a SearchPage of at most MAX_PAGELEN hits, highlights are
+        only worked out for the hits that are displayed. Facet counts of
+        all the matches are in SearchPage.facets.
+        Pages and facet counts are cached until the index changes.
+        """
+        page = max(int(page), 1)
+        pagelen = min(max(int(pagelen), 1), MAX_PAGELEN)
+        user_input = " ".join((user_input or "").split())
+        if isinstance(what, str):
+            what = [what]
+        what = tuple(sorted(set(what or ())))
+        parse_sort(sortedby)
+        normalized = []
+        for field, values in sorted((filters or {}).items()):
+            if field not in FILTER_FIELDS:
+                raise ValueError("Can not filter by %s" % field)
+            if isinstance(values, str):
+                values = [values]
+            if values:
+                normalized.append((field, tuple(sorted(set(values)))))
+        filters = tuple(normalized)
+        generation = self.backend.generation()
+        key = (user_input, page, pagelen, what, filters, sortedby or None,
+               generation)
+        results = _results.get(key)
+        if results is None:
+            facets_key = (user_input, what, filters, generation)
+            facets = _facets.get(facets_key)
+            results = self.backend.search_page(user_input, page, pagelen,
+                                               what, filters, sortedby,
+                                               facets is None)
+            if facets is None:
+                _facets.set(facets_key, results.facets)
+            else:
+                results.facets = facets
+            _results.set(key, results)
         return results
-    
+
+    def complete(self, prefix, limit=COMPLETE_LIMIT):
+        """
+        Complete the word being typed in the search box from the words of
+        titles and tags, most used first. Does not run a query, the word
+        list is rebuilt when the index changes.
+        """
+        limit = min(max(int(limit), 1), MAX_COMPLETE_LIMIT)
+        generation = self.backend.generation()
+        completions = _completions["value"]
+        if completions is None or completions.generation != generation:
+            completions = Completions(self.backend.terms(), generation)
+            _completions["value"] = completions
+        return [(x, completions.counts[x])
+                for x in completions.complete(prefix, limit)]
+
+    def cache_info(self):
+        """
+        Hit and miss counters of the search result and facet caches
+        """
+        return dict(_results.info(), facets=_facets.info())
+
     def update_index(self, title, path, content, tags, created, what, item_id, 
                      username, **opt_args):
         """
-        Update search index
+        Update search index.
+        The write is queued and committed in the background, see flush().
         """
-        writer = self.ix.writer()
-        writer.update_document(title=title, path=path, content=content, 
-                               tags=tags, created=created, what=what,
-                               item_id=item_id, username=username, **opt_args)
-        writer.commit()
-        
+        fields = dict(title=title, path=path, content=content, tags=tags,
+                      created=created, what=what, item_id=item_id,
+                      username=username, **opt_args)
+        queue_write("update", fields)
+
     def delete_from_index(self, path):
         """
-        Delete an item from the index
+        Delete an item from the index.
+        The write is queued and committed in the background, see flush().
         """
-        writer = self.ix.writer()
-        writer.delete_by_term('path', path)
-        writer.commit()
\ No newline at end of file
+        queue_write("delete", path)
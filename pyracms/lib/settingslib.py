@@ -1,9 +1,16 @@
 from ..models import DBSession, Settings
+from .cachelib import CachedValue, SETTINGS, ACL, bump, is_bumped
 from sqlalchemy.orm.exc import NoResultFound
 
 class SettingNotFound(Exception):
     pass
 
+def load_settings(session):
+    return dict(session.query(Settings.name, Settings.value))
+
+# Process-wide copy of the settings table
+_snapshot = CachedValue(load_settings, SETTINGS)
+
 class SettingsLib():
     """
     A library to manage the settings database.
@@ -13,18 +20,35 @@ class SettingsLib():
             self.DBSession = session
         else:
             self.DBSession = DBSession
-            
+
     def list(self): #@ReservedAssignment
         """
         List all the settings
         """
         return self.DBSession.query(Settings.name, Settings.value)
 
+    def mark_dirty(self, name=None):
+        """
+        Bump the settings generation, every process reloads its snapshot
+        once the current transaction commits.
+        """
+        bump(SETTINGS, self.DBSession)
+        if name == "ACL":
+            bump(ACL, self.DBSession)
+
+    def snapshot(self):
+        """
+        Return a dictionary of all the settings, shared by the whole process.
+        Reloaded with a single query after a settings write commits.
+        """
+        return _snapshot.get(self.DBSession)
+
     def create(self, name, value=""):
         """
         Update a page
         Raise PageNotFound if page does not exist
         """
+        self.mark_dirty(name)
         self.DBSession.add(Settings(name, value))
 
     def update(self, name, value):
@@ -33,6 +57,7 @@ class SettingsLib():
         Raise PageNotFound if page does not exist
         """
         setting = self.show_setting(name, True)
+        self.mark_dirty(name)
         setting.value = value
 
     def has_setting(self, name):
@@ -46,7 +71,14 @@ class SettingsLib():
         """
         Get setting object.
         Raise SettingNotFound if setting does not exist.
+        Values are served from the snapshot unless this transaction
+        has written to the settings table.
         """
+        if not as_obj and not is_bumped(SETTINGS, self.DBSession):
+            try:
+                return self.snapshot()[name]
+            except KeyError:
+                raise SettingNotFound
         try:
             page = self.DBSession.query(Settings).filter_by(name=name).one()
         except NoResultFound:
@@ -55,14 +87,15 @@ class SettingsLib():
             return page
         else:
             return page.value
-    
+
     def to_dict(self):
         return dict(self.DBSession.query(Settings.name, Settings.value))
-    
+
     def from_dict(self, data):
         for k, v in data.items():
+            self.mark_dirty(k)
             try:
                 item = self.show_setting(k, True)
                 item.value = v
             except SettingNotFound:
-                self.DBSession.add(Settings(k, v))
\ No newline at end of file
+                self.DBSession.add(Settings(k, v))
@@ -1,6 +1,24 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
 from datetime import datetime
-from ..models import DBSession, Token, TokenPurpose
+from .cachelib import ReferenceCache, PURPOSES
+from ..models import (DBSession, Token, TokenPurpose, ConsumedToken, User,
+                      expire_time)
 from sqlalchemy.orm.exc import NoResultFound
+import binascii
+import hashlib
+import hmac
+import os
+import time
+
+DATABASE = "database"
+SIGNED = "signed"
+
+# token_mode picks how new tokens are made, see configure()
+_state = {"mode": DATABASE, "secret": None}
+
+# Token purposes by name
+_purposes = ReferenceCache(TokenPurpose, PURPOSES)
 
 class InvalidToken(Exception):
     pass
@@ -8,10 +26,82 @@ class InvalidToken(Exception):
 class InvalidPurpose(Exception):
     pass
 
+def configure(settings, secret=None):
+    """
+    Read token_mode (database or signed) and token_secret from the
+    application settings. secret is used when token_secret is not set.
+    """
+    mode = settings.get("token_mode", DATABASE)
+    if mode not in (DATABASE, SIGNED):
+        raise ValueError("Unknown token_mode %s" % mode)
+    _state["mode"] = mode
+    _state["secret"] = (settings.get("token_secret") or secret or "").encode()
+
+def b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64decode(data):
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def sign(payload):
+    """
+    Shortened HMAC-SHA256 of a token payload
+    """
+    if not _state["secret"]:
+        raise ValueError("token_secret is not configured")
+    return b64encode(hmac.new(_state["secret"], payload.encode(),
+                              hashlib.sha256).digest()[:16])
+
+Purpose = namedtuple("Purpose", "name")
+
+class SignedToken():
+    """
+    A token carrying its own user id, purpose and expiry, checked with
+    its signature instead of a database row.
+    """
+    def __init__(self, user_id, purpose, expires, digest, name):
+        self.user_id = user_id
+        self.purpose = Purpose(purpose)
+        self.expires = expires
+        self.digest = digest
+        self.name = name
+
+    @property
+    def user(self):
+        return DBSession.query(User).get(self.user_id)
+
+    @classmethod
+    def create(cls, user_id, purpose, expires):
+        payload = "%d:%s:%d:%s" % (user_id, purpose, time.mktime(
+            expires.timetuple()), b64encode(os.urandom(6)))
+        return "%s.%s" % (b64encode(payload.encode()), sign(payload))
+
+    @classmethod
+    def parse(cls, name):
+        """
+        Check a token's signature and expiry, raise InvalidToken if
+        either is wrong
+        """
+        try:
+            encoded, digest = name.split(".")
+            payload = b64decode(encoded).decode()
+            user_id, purpose, expires, nonce = payload.split(":")
+            user_id, expires = int(user_id), int(expires)
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            raise InvalidToken
+        if not hmac.compare_digest(sign(payload), digest):
+            raise InvalidToken
+        if expires <= time.time():
+            raise InvalidToken
+        return cls(user_id, purpose, datetime.fromtimestamp(expires), digest,
+                   name)
+
 class TokenLib():
     """
     A library to manage tokens.
     Tokens have many uses, password recovery, registration, an api, etc.
+    With token_mode = signed, tokens are signed instead of stored and only
+    their use is written down.
     """
     
     def get_purpose(self, purpose):
@@ -19,14 +109,22 @@ class TokenLib():
         Get a token purpose record by its name
         """
         try:
-            return DBSession.query(TokenPurpose).filter_by(name=purpose).one()
-        except NoResultFound:
+            return _purposes.get(purpose)
+        except KeyError:
             raise InvalidPurpose
         
     def add_token(self, user, purpose):
         """
-        Add a token to the database
+        Add a token to the database, or sign one in signed mode
         """
+        if _state["mode"] == SIGNED:
+            try:
+                _purposes.snapshot(purpose)
+            except KeyError:
+                raise InvalidPurpose
+            if user.id is None:
+                DBSession.flush()
+            return SignedToken.create(user.id, purpose, expire_time())
         t = Token(user, self.get_purpose(purpose))
         DBSession.add(t)
         DBSession.flush()
@@ -34,32 +132,61 @@ class TokenLib():
     
     def delete_expired(self):
         """
-        Delete all expired tokens
+        Delete all expired tokens, and used signed tokens that have
+        expired, with a statement each.
+        Returns how many were deleted. Run by the sweeper script
+        (pyracms.scripts.sweep), not when tokens are looked up.
         """
         now = datetime.now()
-        for item in DBSession.query(Token).filter(Token.expires <= now):
-            DBSession.delete(item)
+        deleted = DBSession.query(Token).filter(
+            Token.expires <= now).delete(synchronize_session=False)
+        deleted += DBSession.query(ConsumedToken).filter(
+            ConsumedToken.expires <= now).delete(synchronize_session=False)
+        return deleted
     
     def expire_token(self, token):
         """
         Expire a token
         """
-        token.expires = datetime(1900,1,1)
+        if isinstance(token, SignedToken):
+            DBSession.add(ConsumedToken(token.digest, token.expires))
+        else:
+            token.expires = datetime(1900,1,1)
         
     def get_token(self, token, expire=True, purpose=None):
         """
-        Get a token, raise InvalidToken if missing.
+        Get a token, raise InvalidToken if missing or expired.
         Tokens are expired on first use by default.
         """
-        self.delete_expired()
+        if "." in token:
+            return self.get_signed_token(token, expire, purpose)
+        query = DBSession.query(Token).filter(Token.name == token,
+                                              Token.expires > datetime.now())
+        if purpose:
+            query = query.join(Token.purpose).filter(
+                TokenPurpose.name == purpose)
         try:
-            if purpose:
-                t = DBSession.query(Token).filter_by(name=token,
-                            purpose_id=self.get_purpose(purpose).id).one()
-            else:
-                t = DBSession.query(Token).filter_by(name=token).one()
-            if expire:
-                self.expire_token(t)
-            return t
+            t = query.one()
         except NoResultFound:
-            raise InvalidToken
\ No newline at end of file
+            if purpose:
+                self.get_purpose(purpose)
+            raise InvalidToken
+        if expire:
+            self.expire_token(t)
+        return t
+
+    def get_signed_token(self, token, expire=True, purpose=None):
+        """
+        Check a signed token, raise InvalidToken if it is not valid or
+        has already been used.
+        """
+        t = SignedToken.parse(token)
+        if purpose and t.purpose.name != purpose:
+            self.get_purpose(purpose)
+            raise InvalidToken
+        if DBSession.query(ConsumedToken.id).filter(
+                ConsumedToken.digest == t.digest).first():
+            raise InvalidToken
+        if expire:
+            self.expire_token(t)
+        return t
@@ -1,7 +1,8 @@
 from ..models import DBSession, User, Group
+from sqlalchemy import event
 from sqlalchemy.orm.exc import NoResultFound
-import json
-from .settingslib import SettingsLib
+from .cachelib import CachedValue, ReferenceCache, ACL, GROUPS, USERS, bump
+from ..factory import compiled_acl
 
 class UserNotFound(Exception):
     pass
@@ -9,6 +10,33 @@ class UserNotFound(Exception):
 class GroupNotFound(Exception):
     pass
 
+@event.listens_for(User.groups, "append", raw=True)
+@event.listens_for(User.groups, "remove", raw=True)
+def groups_changed(state, value, initiator):
+    """
+    Group membership changed, drop cached principals
+    """
+    bump(USERS, state.session)
+
+def load_group_permissions(session):
+    """
+    Map lower case group names to the permissions the ACL allows them
+    """
+    result = {}
+    prefix = "group:"
+    for action, who, permission in compiled_acl(session):
+        if action.lower() != "allow":
+            continue
+        if who.startswith(prefix):
+            who = who[len(prefix):]
+        result.setdefault(who.lower(), []).append(permission)
+    return result
+
+_group_permissions = CachedValue(load_group_permissions, ACL)
+
+# Group rows by name
+_groups = ReferenceCache(Group, GROUPS)
+
 class UserLib():
     """
     A library to manage the user database.
@@ -111,6 +139,7 @@ class UserLib():
         Validate username and change password.
         """
         user = self.show(username)
+        bump(USERS)
         user.password = password
 
     def show_group(self, name):
@@ -118,20 +147,18 @@ class UserLib():
         Get a group from its groupname
         Raise GroupNotFound if group does not exist
         """
-        try:
-            grp = DBSession.query(Group).filter_by(name=name).one()
-        except NoResultFound:
-            raise GroupNotFound
-        
         if not name:
             raise GroupNotFound
-        
-        return grp
+        try:
+            return _groups.get(name)
+        except KeyError:
+            raise GroupNotFound
 
     def create_user(self, name, full_name, email_address, password, sex):
         """
         Create a user. Returns the user object.
         """
+        bump(USERS)
         user = User(name)
         user.email_address = email_address
         user.full_name = full_name
@@ -146,6 +173,7 @@ class UserLib():
         Update a user. Returns the user object.
         """
         user = self.show(name)
+        bump(USERS)
         user.email_address = email_address
         user.full_name = full_name
         return user
@@ -155,12 +183,15 @@ class UserLib():
         Delete a user.
         """
         user = self.show(name)
+        bump(USERS)
         DBSession.delete(user)
         
     def create_group(self, group_name, display_name, users=[]):
         """
         Create a group. Returns the group object.
         """
+        bump(USERS)
+        bump(GROUPS)
         group = Group()
         group.name = group_name
         group.display_name = display_name
@@ -184,18 +215,10 @@ class UserLib():
         :return: List of permissions
         """
 
-        groups = self.list_users_groups(user_name)
-        s = SettingsLib()
-        ACLs = json.loads(s.show_setting("ACL"))
+        group_permissions = _group_permissions.get()
         result = []
-        prefix = "group:"
-        for ACL in ACLs:
-            if ACL[1].startswith(prefix):
-                ACL[1] = ACL[1][len(prefix):]
-            for group in groups:
-                if (group.lower() == ACL[1].lower() and
-                        ACL[0].lower() == "allow"):
-                    result.append(ACL[2])
+        for group in self.list_users_groups(user_name):
+            result.extend(group_permissions.get(group.lower(), []))
         return result
 
     def count(self):
@@ -5,17 +5,28 @@ from pyramid.security import authenticated_userid, Everyone, has_permission
 import markdown
 import postmarkup
 import pytz
-from json import loads
 from os.path import splitext
 
 from ..deform_schemas.userarea import LoginSchema
-from .helperlib import get_username
+from ..factory import RootFactory, compiled_acl
+from .cachelib import (CachedValue, LRUCache, ACL, MENUS, generation,
+                       is_bumped)
+from .helperlib import get_username, cached_route_url
 from .menulib import MenuLib, MenuGroupNotFound
 from .restlib import html_body
 from .userlib import UserLib, UserNotFound
 from .filelib import FileLib
 from .settingslib import SettingsLib
 
+def load_acl_principals(session):
+    return frozenset(ace[1] for ace in compiled_acl(session))
+
+# Principals named by the ACL, the only ones that change a menu
+_acl_principals = CachedValue(load_acl_principals, ACL)
+
+# Rendered menus for the root context, see WidgetLib.generate_menu
+_rendered_menus = LRUCache(maxsize=1000)
+
 class WidgetLib():
     def __init__(self):
         self.bbcode = postmarkup.render_bbcode
@@ -123,6 +134,25 @@ class WidgetLib():
         A quite complicated function which generates a list of menu items.
         Each item has certain permissions which may hinder 
         it being displayed.
+        Menus for the root context without template arguments are cached
+        per menu group, set of principals and application url.
+        """
+        if (tmpl_args or not isinstance(context, RootFactory) or
+                is_bumped(MENUS) or is_bumped(ACL)):
+            return self.build_menu(name, context, request, tmpl_args)
+        principals = (frozenset(request.effective_principals) &
+                      _acl_principals.get())
+        key = (name, principals, request.application_url,
+               generation(MENUS), generation(ACL))
+        result = _rendered_menus.get(key)
+        if result is None:
+            result = self.build_menu(name, context, request, tmpl_args)
+            _rendered_menus.set(key, result)
+        return [list(item) for item in result]
+
+    def build_menu(self, name, context, request, tmpl_args={}):
+        """
+        Generate a list of menu items, see generate_menu
         """
         def quick_permission(permission):
             """
@@ -133,26 +163,24 @@ class WidgetLib():
         NOT_AUTH = 'not_authenticated'
         result = []
         try:
-            items = m.show_group(name).menu_items
+            items = m.compiled_group(name)
         except MenuGroupNotFound:
             return result
         # Get a list of items in its menu group
         for item in items:
             append = True
-            # If the item has any permissions
-            if item.permissions:
-                # Loop through a comma separated list of permissions
-                for permission in item.permissions.split(","):
-                    # Do not append if find not authenticated permission
-                    # (Only triggers when logged in!)
-                    if (permission == NOT_AUTH and
-                        quick_permission(NOT_AUTH)):
-                        append = False
-                    # Not sure how this works, wrote it with experimentation
-                    if (not quick_permission(permission) and
-                        permission != NOT_AUTH and
-                        permission != Everyone):
-                        append = False
+            # Loop through the item's permissions
+            for permission in item.permissions:
+                # Do not append if find not authenticated permission
+                # (Only triggers when logged in!)
+                if (permission == NOT_AUTH and
+                    quick_permission(NOT_AUTH)):
+                    append = False
+                # Not sure how this works, wrote it with experimentation
+                if (not quick_permission(permission) and
+                    permission != NOT_AUTH and
+                    permission != Everyone):
+                    append = False
             if append:
                 try:
                     if item.type == "url":
@@ -160,14 +188,12 @@ class WidgetLib():
                                        item.name % tmpl_args,
                                        False])
                     elif item.type == "route":
-                        try:
-                            tmpl_args.update(loads(item.route_json))
-                        except Exception as e1:
-                            print("-" * 50)
-                            print(e1)
-                        result.append([request.route_url(item.route_name,
-                                                         **tmpl_args),
-                                       item.name % tmpl_args,
+                        route_args = dict(tmpl_args)
+                        route_args.update(item.route_args)
+                        result.append([cached_route_url(request,
+                                                        item.route_name,
+                                                        **route_args),
+                                       item.name % route_args,
                                        False])
                 except KeyError as e:
                     pass
@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 from sqlalchemy import (Column, Integer, Unicode, UnicodeText, DateTime, Boolean, 
-    BigInteger, Date, Enum)
+    BigInteger, Date, Enum, inspect)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, synonym
+from sqlalchemy.orm import (scoped_session, sessionmaker, relationship, synonym,
+    backref)
 from sqlalchemy.schema import UniqueConstraint, ForeignKey
 from zope.sqlalchemy import register
 import hashlib
@@ -65,6 +66,23 @@ class Group(Base):
     def __unicode__(self):
         return self.name
 
+class FileBlob(Base):
+    """
+    The contents of uploaded files stored once by their sha256 digest,
+    refcount is the number of Files sharing it.
+    """
+    __tablename__ = 'fileblob'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    digest = Column(Unicode(64), index=True, unique=True, nullable=False)
+    size = Column(BigInteger, default=0)
+    refcount = Column(Integer, default=0, nullable=False)
+
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+
 class Files(Base):
     __tablename__ = 'files'
     __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
@@ -80,6 +98,8 @@ class Files(Base):
     is_video = Column(Boolean, default=False, index=True)
     download_count = Column(Integer, default=0, index=True)
     video_duration = Column(Integer, default=0, index=True)
+    blob_id = Column(Integer, ForeignKey('fileblob.id'), index=True)
+    blob = relationship(FileBlob)
 
     def __init__(self, name, mimetype):
         self.name = name
@@ -210,6 +230,18 @@ class MenuGroup(Base):
     def __init__(self, name):
         self.name = name
 
+class CacheGeneration(Base):
+    __tablename__ = 'cache_generation'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(128), index=True, unique=True, nullable=False)
+    generation = Column(Integer, default=0, nullable=False)
+
+    def __init__(self, name, generation=0):
+        self.name = name
+        self.generation = generation
+
 def gen_token():
     return str(uuid.uuid4())
 
@@ -239,12 +271,27 @@ class Token(Base):
                         nullable=False)
     purpose = relationship(TokenPurpose)
     created = Column(DateTime, default=datetime.now)
-    expires = Column(DateTime, default=expire_time)
+    expires = Column(DateTime, default=expire_time, index=True)
 
     def __init__(self, user, purpose):
         self.user = user
         self.purpose = purpose
 
+class ConsumedToken(Base):
+    """
+    Signed tokens that have been used, kept until they expire
+    """
+    __tablename__ = 'consumedtoken'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    digest = Column(Unicode(32), index=True, unique=True, nullable=False)
+    expires = Column(DateTime, index=True, nullable=False)
+
+    def __init__(self, digest, expires):
+        self.digest = digest
+        self.expires = expires
+
 class APIFileUpload(Base):
     __tablename__ = 'apifileupload'
     __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
@@ -260,3 +307,49 @@ class APIFileUpload(Base):
 
     def __init__(self, file_obj):
         self.file_obj = file_obj
+
+class MediaJob(Base):
+    """
+    Thumbnailing of an uploaded file, done by media_pyracms_worker.
+    status is pending, running, done or failed.
+    """
+    __tablename__ = 'mediajob'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey('files.id', ondelete="CASCADE"),
+                     unique=True, nullable=False)
+    file_obj = relationship(Files, backref=backref(
+        "media_job", uselist=False, cascade="all, delete-orphan"))
+    status = Column(Unicode(16), index=True, default="pending",
+                    nullable=False)
+    thumbnail_width = Column(Integer, default=256)
+    thumbnail_height = Column(Integer, default=256)
+    error = Column(UnicodeText)
+    created = Column(DateTime, default=datetime.now)
+    claimed = Column(DateTime, index=True)
+    finished = Column(DateTime)
+
+    def __init__(self, file_obj, thumbnail_size):
+        self.file_obj = file_obj
+        self.thumbnail_width, self.thumbnail_height = thumbnail_size
+
+def upgrade_schema(engine):
+    """
+    Bring a database made by an older initialize_pyracms_db up to date,
+    adding the tables, columns and indexes created since. Does nothing
+    to a database that is not initialized yet.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("files"):
+        return
+    for model in (CacheGeneration, ConsumedToken, FileBlob, MediaJob):
+        model.__table__.create(engine, checkfirst=True)
+    columns = [x["name"] for x in inspector.get_columns("files")]
+    if "blob_id" not in columns:
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ALTER TABLE files ADD COLUMN blob_id "
+                                 "INTEGER REFERENCES fileblob (id)")
+    for model in (Files, Token):
+        for index in model.__table__.indexes:
+            index.create(engine, checkfirst=True)
@@ -0,0 +1,82 @@
+"""
+Compare the search backends on the same generated corpus: documents
+indexed per second and query latency, without the result cache.
+Runs in a temporary directory, nothing is written to the live index.
+"""
+from ..lib import searchlib
+from ..lib.searchlib import BACKENDS, BATCH_SIZE, PAGELEN
+from datetime import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s [documents] [queries]\n'
+          '(example: "%s 10000 1000")' % (cmd, cmd)))
+    sys.exit(1)
+
+def corpus(count, seed=0):
+    """
+    Generate count documents from a fixed vocabulary
+    """
+    rand = random.Random(seed)
+    vocabulary = ["word%d" % i for i in range(5000)]
+    docs = []
+    for i in range(count):
+        docs.append(dict(title=" ".join(rand.sample(vocabulary, 5)),
+                         path="/article/%d" % i,
+                         content=" ".join(rand.choices(vocabulary, k=200)),
+                         tags=" ".join(rand.sample(vocabulary, 3)),
+                         created=datetime(2015, 1, 1), what="article",
+                         item_id="article_%d" % i, username="admin"))
+    return vocabulary, docs
+
+def benchmark(name, docs, queries):
+    """
+    Index docs then run queries with the named backend.
+    Returns documents per second and query times in milliseconds.
+    """
+    searchlib.configure({"search_backend": name,
+                         "search_fts5_path": "search_index.sqlite"})
+    backend = searchlib.get_backend()
+    start = time.time()
+    for i in range(0, len(docs), BATCH_SIZE):
+        backend.write_batch([], docs[i:i + BATCH_SIZE])
+    rate = len(docs) / max(time.time() - start, 0.001)
+    times = []
+    for query in queries:
+        start = time.time()
+        backend.search_page(query, 1, PAGELEN)
+        times.append((time.time() - start) * 1000)
+    backend.close()
+    times.sort()
+    return rate, times
+
+def main(argv=sys.argv):
+    if len(argv) > 3:
+        usage(argv)
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    query_count = int(argv[2]) if len(argv) > 2 else 1000
+    vocabulary, docs = corpus(count)
+    rand = random.Random(1)
+    queries = [" ".join(rand.sample(vocabulary, rand.randint(1, 2)))
+               for i in range(query_count)]
+    cwd = os.getcwd()
+    print("%d documents, %d queries" % (count, query_count))
+    print("%-8s %12s %10s %10s %10s" % ("backend", "docs/sec", "mean ms",
+                                        "p50 ms", "p95 ms"))
+    for name in BACKENDS:
+        tmpdir = tempfile.mkdtemp()
+        os.chdir(tmpdir)
+        try:
+            rate, times = benchmark(name, docs, queries)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+        print("%-8s %12.0f %10.2f %10.2f %10.2f" % (
+            name, rate, sum(times) / len(times), times[len(times) // 2],
+            times[int(len(times) * 0.95)]))
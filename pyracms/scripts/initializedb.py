@@ -1,7 +1,9 @@
-from ..factory import RootFactory
+from ..factory import JsonList
 from ..lib.userlib import UserLib
 from ..lib.settingslib import SettingsLib
-from ..models import DBSession, Base, Menu, MenuGroup, TokenPurpose
+from ..lib.cachelib import SETTINGS, ACL, MENUS, USERS, GROUPS, PURPOSES
+from ..models import (DBSession, Base, Menu, MenuGroup, TokenPurpose,
+                      CacheGeneration)
 from pyramid.paster import get_appsettings, setup_logging
 from pyramid.security import Everyone, Allow, Authenticated
 from sqlalchemy import engine_from_config
@@ -147,6 +149,10 @@ def main(argv=sys.argv):
     DBSession.configure(bind=engine)
     Base.metadata.create_all(engine)
     with transaction.manager:
+        # Cache generations
+        for name in (SETTINGS, ACL, MENUS, USERS, GROUPS, PURPOSES):
+            DBSession.add(CacheGeneration(name))
+
         # Default Users
         u = UserLib()
         
@@ -156,18 +162,18 @@ def main(argv=sys.argv):
         u.create_group(Authenticated, "Logged in")
 
         # Default ACL
-        acl = RootFactory(session=DBSession)
-        acl.__acl__.append((Allow, Everyone, Everyone))
-        acl.__acl__.append((Allow, Authenticated, Authenticated))
-        acl.__acl__.append((Allow, Authenticated, "not_authenticated"))
-        acl.__acl__.append((Allow, Authenticated, "userarea_edit"))
-        acl.__acl__.append((Allow, Authenticated, 'vote'))
-        acl.__acl__.append((Allow, "group:admin", "group:admin"))
-        acl.__acl__.append((Allow, "group:admin", "edit_menu"))
-        acl.__acl__.append((Allow, "group:admin", "edit_acl"))
-        acl.__acl__.append((Allow, "group:admin", "edit_settings"))
-        acl.__acl__.append((Allow, "group:admin", "file_upload"))
-        acl.__acl__.append((Allow, "group:admin", "backup"))
+        acl = JsonList(session=DBSession)
+        acl.append((Allow, Everyone, Everyone))
+        acl.append((Allow, Authenticated, Authenticated))
+        acl.append((Allow, Authenticated, "not_authenticated"))
+        acl.append((Allow, Authenticated, "userarea_edit"))
+        acl.append((Allow, Authenticated, 'vote'))
+        acl.append((Allow, "group:admin", "group:admin"))
+        acl.append((Allow, "group:admin", "edit_menu"))
+        acl.append((Allow, "group:admin", "edit_acl"))
+        acl.append((Allow, "group:admin", "edit_settings"))
+        acl.append((Allow, "group:admin", "file_upload"))
+        acl.append((Allow, "group:admin", "backup"))
 
         # Add Settings
         s = SettingsLib()
@@ -0,0 +1,109 @@
+"""
+Make the thumbnails of uploads queued with media_queue = true.
+
+Jobs are claimed from the mediajob table and thumbnailed in a pool of
+processes, each result is committed as soon as it is ready. Several
+workers can share the queue. Jobs claimed more than LEASE seconds ago,
+most likely by a worker that died, are put back in the queue.
+"""
+from ..lib.filelib import (FileLib, PENDING, RUNNING, DONE, FAILED,
+                           finish_thumbnail, make_thumbnail, static_path)
+from ..models import DBSession, MediaJob, upgrade_schema
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from os.path import join
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import os
+import sys
+import time
+import transaction
+
+# Seconds a claimed job may run before another worker takes it over
+LEASE = 3600
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri> [processes] [interval]\n'
+          '(example: "%s development.ini 4 5")' % (cmd, cmd)))
+    sys.exit(1)
+
+def requeue(lease=LEASE):
+    """
+    Put jobs claimed more than lease seconds ago back in the queue
+    """
+    stale = datetime.now() - timedelta(seconds=lease)
+    with transaction.manager:
+        return DBSession.query(MediaJob).filter(
+            MediaJob.status == RUNNING, MediaJob.claimed < stale).update(
+            {MediaJob.status: PENDING}, synchronize_session=False)
+
+def claim(settings, limit):
+    """
+    Mark up to limit pending jobs as running. Returns a list of
+    (job id, file path, thumbnail size), jobs taken by another worker
+    meanwhile are left out.
+    """
+    upload_dir = join(static_path(settings), FileLib.UPLOAD_DIR)
+    jobs = []
+    with transaction.manager:
+        for job in DBSession.query(MediaJob).filter_by(
+                status=PENDING).order_by(MediaJob.id).limit(limit):
+            claimed = DBSession.query(MediaJob).filter_by(
+                id=job.id, status=PENDING).update(
+                {MediaJob.status: RUNNING, MediaJob.claimed: datetime.now()},
+                synchronize_session=False)
+            if claimed:
+                jobs.append((job.id, join(upload_dir, job.file_obj.uuid,
+                                          job.file_obj.name),
+                             (job.thumbnail_width, job.thumbnail_height)))
+    return jobs
+
+def finish(job_id, result=None, error=None):
+    """
+    Record the result of a job, flipping upload_complete of its file
+    """
+    with transaction.manager:
+        job = DBSession.query(MediaJob).get(job_id)
+        if job is None:
+            return
+        job.finished = datetime.now()
+        if error is not None:
+            job.status = FAILED
+            job.error = str(error)
+        else:
+            job.status = DONE
+            finish_thumbnail(job.file_obj, *result)
+
+def run(settings, executor, limit):
+    """
+    Process one batch of jobs. Returns the number of jobs processed.
+    """
+    jobs = claim(settings, limit)
+    futures = dict((executor.submit(make_thumbnail, path, size), job_id)
+                   for job_id, path, size in jobs)
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            finish(futures[future], error=e)
+        else:
+            finish(futures[future], result)
+    return len(jobs)
+
+def main(argv=sys.argv):
+    if len(argv) not in (2, 3, 4):
+        usage(argv)
+    config_uri = argv[1]
+    procs = int(argv[2]) if len(argv) > 2 else os.cpu_count() or 1
+    interval = int(argv[3]) if len(argv) > 3 else 5
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    upgrade_schema(engine)
+    with ProcessPoolExecutor(procs) as executor:
+        while True:
+            requeue()
+            if not run(settings, executor, procs * 2):
+                time.sleep(interval)
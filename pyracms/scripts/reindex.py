@@ -0,0 +1,198 @@
+"""
+Rebuild the search index from the database.
+
+Content is gathered from providers registered under the "pyracms.search"
+entry point group. A provider is a callable taking a database session and
+returning an iterable of dictionaries with the arguments of
+SearchLib.update_index (title, path, content, tags, created, what,
+item_id, username).
+
+The new index is built in its own directory next to whoosh_index, then
+whoosh_index (a symlink) is pointed at it in one rename, so searching
+keeps working throughout. Running processes reopen the index when they
+notice the link has changed. With search_backend=fts5 the table is
+rebuilt in a single transaction instead.
+
+Given a content type, only the sub-index of that type is rebuilt, in
+place, leaving the other types alone.
+"""
+from ..lib import searchlib
+from ..lib.searchlib import INDEX_NAME, LOCK_TIMEOUT, schema
+from ..models import DBSession, upgrade_schema
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+from whoosh.index import LockError, create_in, exists_in, open_dir
+from whoosh.writing import CLEAR
+import os
+import pkg_resources
+import shutil
+import sys
+import time
+import transaction
+
+ENTRY_POINT = "pyracms.search"
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri> [processes] [content type]\n'
+          '(example: "%s development.ini 4 thread")' % (cmd, cmd)))
+    sys.exit(1)
+
+def load_providers():
+    """
+    Load every content provider registered by the installed packages
+    """
+    return [entry_point.load()
+            for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT)]
+
+def documents(session, providers):
+    for provider in providers:
+        for fields in provider(session):
+            yield fields
+
+def build(path, docs, procs=1):
+    """
+    Write all the documents to a new index in path, one sub-index per
+    content type. Returns the number of documents written.
+    """
+    os.mkdir(path)
+    writers = {}
+    count = 0
+    try:
+        for fields in docs:
+            name = searchlib.index_name(fields.get("what"))
+            if name not in writers:
+                ix = create_in(path, schema, indexname=name)
+                writers[name] = (ix, ix.writer(procs=procs,
+                                               multisegment=True))
+            writers[name][1].add_document(**fields)
+            count += 1
+    except:
+        for ix, writer in writers.values():
+            writer.cancel()
+            ix.close()
+        raise
+    for ix, writer in writers.values():
+        writer.commit()
+        ix.close()
+    return count
+
+def swap(path, index_name=INDEX_NAME):
+    """
+    Point index_name at the index in path, then remove all but the
+    previous index. The first time an index directory is replaced it is
+    moved aside, which leaves a brief moment without an index.
+    """
+    previous = None
+    if os.path.islink(index_name):
+        previous = os.path.realpath(index_name)
+    elif os.path.isdir(index_name):
+        previous = "%s.%d.old" % (index_name, time.time())
+        os.rename(index_name, previous)
+    link = "%s.%d.link" % (index_name, os.getpid())
+    os.symlink(os.path.basename(path), link)
+    os.replace(link, index_name)
+    # Keep the previous index for processes still reading it
+    keep = set(os.path.realpath(x) for x in (path, previous) if x)
+    parent = os.path.dirname(os.path.abspath(index_name))
+    prefix = os.path.basename(index_name) + "."
+    for name in os.listdir(parent):
+        full = os.path.join(parent, name)
+        if (name.startswith(prefix) and os.path.isdir(full) and
+                not os.path.islink(full) and
+                os.path.realpath(full) not in keep):
+            shutil.rmtree(full)
+
+def reindex(session, providers, procs=1, index_name=INDEX_NAME):
+    """
+    Rebuild the index and swap it in. Returns the number of documents.
+    The live sub-indexes stay write locked during the rebuild, so edits
+    made meanwhile are held by the writer thread until the locks are
+    released and then go into the new index.
+    """
+    if not providers:
+        raise ValueError("No search providers, the index would be emptied")
+    locked = []
+    try:
+        for name in searchlib.index_names(index_name):
+            old = open_dir(index_name, indexname=name)
+            lock = old.lock("WRITELOCK")
+            lock.acquire(blocking=True)
+            locked.append((old, lock))
+        path = "%s.%d" % (index_name, time.time() * 1000)
+        count = build(path, documents(session, providers), procs)
+        swap(path, index_name)
+    finally:
+        for old, lock in locked:
+            lock.release()
+            old.close()
+    return count
+
+def reindex_type(session, providers, what, procs=1,
+                 index_name=INDEX_NAME):
+    """
+    Rebuild the sub-index of one content type in place, the other
+    sub-indexes are not rewritten. Searches see the old documents until
+    the new ones are committed. Returns the number of documents.
+    """
+    if not providers:
+        raise ValueError("No search providers, the index would be emptied")
+    name = searchlib.index_name(what)
+    if exists_in(index_name, indexname=name):
+        ix = open_dir(index_name, indexname=name)
+    else:
+        if not os.path.isdir(index_name):
+            os.mkdir(index_name)
+        ix = create_in(index_name, schema, indexname=name)
+    while True:
+        try:
+            writer = ix.writer(procs=procs, multisegment=True,
+                               timeout=LOCK_TIMEOUT)
+            break
+        except LockError:
+            print("Search index is locked, retrying")
+    count = 0
+    try:
+        for fields in documents(session, providers):
+            if fields.get("what") == what:
+                writer.add_document(**fields)
+                count += 1
+    except:
+        writer.cancel()
+        ix.close()
+        raise
+    writer.commit(mergetype=CLEAR)
+    ix.close()
+    return count
+
+def main(argv=sys.argv):
+    if len(argv) not in (2, 3, 4):
+        usage(argv)
+    config_uri = argv[1]
+    procs = int(argv[2]) if len(argv) > 2 else os.cpu_count() or 1
+    what = argv[3] if len(argv) > 3 else None
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    upgrade_schema(engine)
+    searchlib.configure(settings)
+    backend = searchlib.get_backend()
+    providers = load_providers()
+    if not providers:
+        # An index built from nothing would replace the live one
+        print('No search providers are registered under the "%s" entry '
+              'point group, the index is left alone.' % ENTRY_POINT)
+        usage(argv)
+    start = time.time()
+    with transaction.manager:
+        if hasattr(backend, "rebuild"):
+            count = backend.rebuild(documents(DBSession, providers), what)
+        elif what:
+            count = reindex_type(DBSession, providers, what, procs)
+        else:
+            count = reindex(DBSession, providers, procs)
+    elapsed = max(time.time() - start, 0.001)
+    print("Indexed %d documents from %d providers in %.1f seconds "
+          "(%.0f documents/sec)" % (count, len(providers), elapsed,
+                                     count / elapsed))
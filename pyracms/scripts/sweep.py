@@ -0,0 +1,41 @@
+"""
+Delete expired tokens. Run it from cron, or give it an interval in
+seconds to keep sweeping.
+"""
+from ..lib.tokenlib import TokenLib
+from ..models import DBSession, upgrade_schema
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import os
+import sys
+import time
+import transaction
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri> [interval]\n'
+          '(example: "%s development.ini 3600")' % (cmd, cmd)))
+    sys.exit(1)
+
+def sweep():
+    """
+    Delete expired tokens in their own transaction
+    """
+    with transaction.manager:
+        return TokenLib().delete_expired()
+
+def main(argv=sys.argv):
+    if len(argv) not in (2, 3):
+        usage(argv)
+    config_uri = argv[1]
+    interval = int(argv[2]) if len(argv) == 3 else None
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    upgrade_schema(engine)
+    while True:
+        print("Deleted %d expired tokens" % sweep())
+        if not interval:
+            break
+        time.sleep(interval)
@@ -1,13 +1,111 @@
+from .lib.cachelib import LRUCache, ACL, USERS, generation, is_bumped
 from .models import DBSession, User
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import Allow, ACLAllowed, ACLDenied
+
+# userid -> principals, kept in this process rather than the session cookie
+_principals = LRUCache(maxsize=1000, ttl=300)
 
 def groupfinder(userid, request):
-    if request.session.get('groupfinder'):
-        if request.session['groupfinder'].get(userid):
-            return request.session['groupfinder'][userid]
-    else:
-        request.session['groupfinder'] = {}
+    """
+    Get the principals of a user. Cached until the user's groups or the
+    ACL change.
+    """
+    cacheable = not (is_bumped(USERS) or is_bumped(ACL))
+    key = (userid, generation(USERS), generation(ACL))
+    if cacheable:
+        result = _principals.get(key)
+        if result is not None:
+            return result
     auth = DBSession.query(User).filter(User.name==userid).first()
     if auth:
         result = [('group:%s' % group.name) for group in auth.groups]
-        request.session['groupfinder'][userid] = result
-        return result
\ No newline at end of file
+        if cacheable:
+            _principals.set(key, result)
+        return result
+
+class ACLIndex(object):
+    """
+    An access control list compiled to principal -> permission -> first
+    matching entry, so a lookup does not have to walk the whole list.
+    """
+    def __init__(self, acl):
+        self.acl = acl
+        self.permissions = {}
+        # Entries whose permissions can only be tested with "in",
+        # such as ALL_PERMISSIONS
+        self.containers = {}
+        for position, ace in enumerate(acl):
+            action, principal, permissions = ace
+            if isinstance(permissions, str):
+                permissions = [permissions]
+            if isinstance(permissions, (list, tuple, set, frozenset)):
+                by_permission = self.permissions.setdefault(principal, {})
+                for permission in permissions:
+                    by_permission.setdefault(permission, (position, ace))
+            else:
+                self.containers.setdefault(principal, []).append(
+                    (position, ace, permissions))
+
+    def lookup(self, principals, permission):
+        """
+        Return the first entry matching any of the principals, or None
+        """
+        found = None
+        for principal in principals:
+            match = self.permissions.get(principal, {}).get(permission)
+            if match and (not found or match[0] < found[0]):
+                found = match
+            for position, ace, permissions in self.containers.get(
+                                                            principal, ()):
+                if found and found[0] < position:
+                    break
+                if permission in permissions:
+                    found = (position, ace)
+                    break
+        if found:
+            return found[1]
+
+class IndexedACLAuthorizationPolicy(ACLAuthorizationPolicy):
+    """
+    Same rules as ACLAuthorizationPolicy, but the shared RootFactory ACL
+    is compiled once into an ACLIndex and results are memoized for the
+    rest of the request.
+    Contexts with a lineage or a mutable ACL use the normal policy.
+    """
+    def __init__(self):
+        self.compiled = None
+
+    def get_index(self, acl):
+        compiled = self.compiled
+        if compiled is None or compiled.acl is not acl:
+            compiled = ACLIndex(acl)
+            self.compiled = compiled
+        return compiled
+
+    def permits(self, context, principals, permission):
+        acl = getattr(context, '__acl__', None)
+        if (not isinstance(acl, tuple) or
+                getattr(context, '__parent__', None) is not None):
+            return super(IndexedACLAuthorizationPolicy, self).permits(
+                context, principals, permission)
+        request = getattr(context, 'request', None)
+        memo = None
+        key = (id(acl), frozenset(principals), permission)
+        if request is not None:
+            memo = getattr(request, 'pyracms_permits', None)
+            if memo is None:
+                memo = request.pyracms_permits = {}
+            if key in memo:
+                return memo[key]
+        ace = self.get_index(acl).lookup(principals, permission)
+        if ace is None:
+            result = ACLDenied('<default deny>', acl, permission, principals,
+                               context)
+        elif ace[0] == Allow:
+            result = ACLAllowed(ace, acl, permission, principals, context)
+        else:
+            result = ACLDenied(ace, acl, permission, principals, context)
+        if memo is not None:
+            memo[key] = result
+        return result
@@ -29,4 +29,989 @@ class TestMyView(unittest.TestCase):
         self.assertEqual(info['project'], 'pyracms')
         """
         pass
-    
\ No newline at end of file
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine, event
+        from .lib import cachelib
+        self.engine = create_engine('sqlite://')
+        from .models import Base
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        cachelib.reset()
+        self.queries = []
+        event.listen(self.engine, "before_cursor_execute",
+                     self.count_query)
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def count_query(self, conn, cursor, statement, *args):
+        if not "cache_generation" in statement:
+            self.queries.append(statement)
+
+class TestUpgradeSchema(unittest.TestCase):
+    """
+    A database made by the initialize_pyracms_db of the first release
+    """
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine
+        from .lib import cachelib
+        from .models import Base
+        self.engine = create_engine('sqlite://')
+        added = ("cache_generation", "consumedtoken", "fileblob", "mediajob",
+                 "files")
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE files (id INTEGER PRIMARY KEY, name "
+                "VARCHAR(1024) NOT NULL, uuid VARCHAR(128) NOT NULL, "
+                "mimetype VARCHAR(128) NOT NULL, size BIGINT, created "
+                "DATETIME, upload_complete BOOLEAN, is_picture BOOLEAN, "
+                "is_video BOOLEAN, download_count INTEGER, "
+                "video_duration INTEGER)")
+        Base.metadata.create_all(self.engine, tables=[
+            x for x in Base.metadata.sorted_tables if x.name not in added])
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("DROP INDEX ix_token_expires")
+        DBSession.configure(bind=self.engine)
+        cachelib.reset()
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_upgrade(self):
+        from sqlalchemy import inspect
+        from .lib.settingslib import SettingsLib
+        from .models import Files, upgrade_schema
+        upgrade_schema(self.engine)
+        upgrade_schema(self.engine)
+        self.assertIn("ix_token_expires", [x["name"] for x in
+                      inspect(self.engine).get_indexes("token")])
+        with transaction.manager:
+            SettingsLib().create("TITLE", "Untitled Website")
+        with transaction.manager:
+            self.assertEqual(SettingsLib().show_setting("TITLE"),
+                             "Untitled Website")
+            self.assertEqual(DBSession.query(Files).filter_by(
+                blob_id=None).count(), 0)
+
+    def test_signed_tokens(self):
+        from .lib import tokenlib
+        from .lib.userlib import UserLib
+        from .models import TokenPurpose, upgrade_schema
+        upgrade_schema(self.engine)
+        tokenlib.configure({"token_mode": "signed", "token_secret": "s3cr3t"})
+        try:
+            t = tokenlib.TokenLib()
+            with transaction.manager:
+                DBSession.add(TokenPurpose("register"))
+                user = UserLib().create_user("bob", "Bob", "bob@example.com",
+                                             "bob", "Male")
+                name = t.add_token(user, "register")
+            with transaction.manager:
+                t.get_token(name, True, "register")
+            with transaction.manager:
+                self.assertRaises(tokenlib.InvalidToken, t.get_token, name)
+        finally:
+            tokenlib.configure({})
+
+class TestCacheLib(CacheTestCase):
+    def test_bump_on_commit(self):
+        from .lib import cachelib
+        with transaction.manager:
+            self.assertEqual(cachelib.generation(cachelib.MENUS), 0)
+            cachelib.bump(cachelib.MENUS)
+            cachelib.bump(cachelib.MENUS)
+            self.assertTrue(cachelib.is_bumped(cachelib.MENUS))
+        self.assertFalse(cachelib.is_bumped(cachelib.MENUS))
+        with transaction.manager:
+            self.assertEqual(cachelib.generation(cachelib.MENUS), 1)
+            cachelib.bump(cachelib.MENUS)
+        with transaction.manager:
+            self.assertEqual(cachelib.generation(cachelib.MENUS), 2)
+
+    def test_bump_aborted(self):
+        from .lib import cachelib
+        cachelib.bump(cachelib.MENUS)
+        transaction.abort()
+        with transaction.manager:
+            self.assertEqual(cachelib.generation(cachelib.MENUS), 0)
+
+    def test_cached_value_follows_other_processes(self):
+        from .lib import cachelib
+        from .models import CacheGeneration
+        loads = []
+        cached = cachelib.CachedValue(lambda session: loads.append(1),
+                                      cachelib.MENUS)
+        with transaction.manager:
+            cached.get()
+            cached.get()
+        self.assertEqual(len(loads), 1)
+        # Another process bumps the generation
+        with transaction.manager:
+            DBSession.add(CacheGeneration(cachelib.MENUS, 5))
+        with transaction.manager:
+            cached.get()
+        self.assertEqual(len(loads), 1)
+        cachelib.poll()
+        with transaction.manager:
+            cached.get()
+        self.assertEqual(len(loads), 2)
+
+    def test_cached_value_keyed_by_its_transaction(self):
+        from .lib import cachelib
+        from time import time
+        loads = []
+        cached = cachelib.CachedValue(lambda session: loads.append(1),
+                                      cachelib.MENUS)
+        with transaction.manager:
+            # The poll has seen a commit this transaction does not see
+            cachelib._state["generations"] = {cachelib.MENUS: 1}
+            cachelib._state["polled"] = time()
+            cached.get()
+        with transaction.manager:
+            cachelib.bump(cachelib.MENUS)
+        with transaction.manager:
+            cached.get()
+        self.assertEqual(len(loads), 2)
+
+class TestSettingsLib(CacheTestCase):
+    def test_reads_served_from_snapshot(self):
+        from .lib.settingslib import SettingsLib, SettingNotFound
+        s = SettingsLib()
+        with transaction.manager:
+            s.create("TITLE", "Untitled Website")
+        with transaction.manager:
+            self.assertEqual(s.show_setting("TITLE"), "Untitled Website")
+        del self.queries[:]
+        with transaction.manager:
+            self.assertEqual(s.show_setting("TITLE"), "Untitled Website")
+            self.assertRaises(SettingNotFound, s.show_setting, "MISSING")
+        self.assertEqual(self.queries, [])
+
+    def test_snapshot_invalidated_on_commit(self):
+        from .lib.settingslib import SettingsLib
+        s = SettingsLib()
+        with transaction.manager:
+            s.create("TITLE", "Untitled Website")
+        with transaction.manager:
+            s.show_setting("TITLE")
+            s.update("TITLE", "Pynguins")
+            self.assertEqual(s.show_setting("TITLE"), "Pynguins")
+        with transaction.manager:
+            self.assertEqual(s.show_setting("TITLE"), "Pynguins")
+
+    def test_aborted_write_keeps_snapshot(self):
+        from .lib.settingslib import SettingsLib
+        s = SettingsLib()
+        with transaction.manager:
+            s.create("TITLE", "Untitled Website")
+        with transaction.manager:
+            s.show_setting("TITLE")
+        s.update("TITLE", "Pynguins")
+        transaction.abort()
+        del self.queries[:]
+        with transaction.manager:
+            self.assertEqual(s.show_setting("TITLE"), "Untitled Website")
+        self.assertEqual(self.queries, [])
+
+class TestRootFactory(CacheTestCase):
+    def test_acl_shared_between_requests(self):
+        from .factory import JsonList, RootFactory
+        with transaction.manager:
+            JsonList([("Allow", "system.Everyone", "system.Everyone")])
+        first = RootFactory(testing.DummyRequest()).__acl__
+        del self.queries[:]
+        second = RootFactory(testing.DummyRequest()).__acl__
+        self.assertEqual(self.queries, [])
+        self.assertIs(first, second)
+        self.assertEqual(first, (("Allow", "system.Everyone",
+                                  "system.Everyone"),))
+
+    def test_acl_rebuilt_on_change(self):
+        from .factory import JsonList, RootFactory
+        with transaction.manager:
+            JsonList([("Allow", "system.Everyone", "system.Everyone")])
+        RootFactory(testing.DummyRequest())
+        with transaction.manager:
+            JsonList([("Deny", "system.Everyone", "edit_acl")])
+        self.assertEqual(RootFactory(testing.DummyRequest()).__acl__,
+                         (("Deny", "system.Everyone", "edit_acl"),))
+
+    def test_acl_editable_with_session(self):
+        from .factory import RootFactory
+        with transaction.manager:
+            RootFactory(session=DBSession).__acl__.append(
+                ("Allow", "group:admin", "edit_forum"))
+        self.assertEqual(RootFactory(testing.DummyRequest()).__acl__,
+                         (("Allow", "group:admin", "edit_forum"),))
+
+class TestJsonList(CacheTestCase):
+    def test_instances_share_transaction(self):
+        from .factory import JsonList, RootFactory
+        with transaction.manager:
+            JsonList([("Allow", "system.Everyone", "system.Everyone")])
+        with transaction.manager:
+            RootFactory(session=DBSession).__acl__.append(
+                ("Allow", "group:admin", "forum"))
+            RootFactory(session=DBSession).__acl__.append(
+                ("Allow", "group:admin", "gallery"))
+            self.assertEqual(len(JsonList()[1:]), 2)
+        with transaction.manager:
+            self.assertEqual(JsonList().data,
+                             [["Allow", "system.Everyone", "system.Everyone"],
+                              ["Allow", "group:admin", "forum"],
+                              ["Allow", "group:admin", "gallery"]])
+
+    def test_reads_do_not_write(self):
+        from .factory import JsonList
+        with transaction.manager:
+            JsonList([("Allow", "system.Everyone", "system.Everyone")])
+        del self.queries[:]
+        with transaction.manager:
+            acl = JsonList()
+            acl.count(["Allow", "system.Everyone", "system.Everyone"])
+            acl.index(["Allow", "system.Everyone", "system.Everyone"])
+            acl.copy()
+            self.assertFalse(acl.dirty)
+        self.assertFalse([x for x in self.queries
+                          if not x.startswith("SELECT")])
+
+    def test_saved_once_on_commit(self):
+        from .factory import JsonList
+        from .lib.settingslib import SettingsLib
+        with transaction.manager:
+            JsonList([("Allow", "system.Everyone", "system.Everyone")])
+        del self.queries[:]
+        with transaction.manager:
+            acl = JsonList()
+            acl.append(("Allow", "group:admin", "edit_acl"))
+            acl.append(("Allow", "group:admin", "edit_acl"))
+            acl.insert(0, ("Deny", "system.Everyone", "edit_acl"))
+            self.assertTrue(acl.dirty)
+        self.assertEqual(len([x for x in self.queries
+                              if x.startswith("UPDATE settings")]), 1)
+        with transaction.manager:
+            self.assertEqual(JsonList().data,
+                             [["Deny", "system.Everyone", "edit_acl"],
+                              ["Allow", "system.Everyone", "system.Everyone"],
+                              ["Allow", "group:admin", "edit_acl"]])
+
+class TestIndexedACLAuthorizationPolicy(unittest.TestCase):
+    acl = (("Allow", "system.Everyone", "system.Everyone"),
+           ("Deny", "group:banned", "vote"),
+           ("Allow", "system.Authenticated", ("vote", "userarea_edit")),
+           ("Allow", "group:admin", "edit_acl"),
+           ("Deny", "group:admin", "edit_acl"),
+           ("Deny", "system.Everyone", "edit_acl"))
+
+    def make_context(self, acl, request=None):
+        from .factory import RootFactory
+        context = RootFactory.__new__(RootFactory)
+        context.request = request
+        context.__acl__ = acl
+        return context
+
+    def test_same_result_as_acl_policy(self):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from pyramid.security import ALL_PERMISSIONS
+        from .security import IndexedACLAuthorizationPolicy
+        acl = self.acl + (("Allow", "group:root", ALL_PERMISSIONS),
+                          ("Allow", "group:root", "root"))
+        principal_sets = [["system.Everyone"],
+                          ["system.Everyone", "system.Authenticated"],
+                          ["system.Everyone", "system.Authenticated",
+                           "group:banned"],
+                          ["system.Everyone", "group:admin"],
+                          ["group:root"], ["group:root", "group:banned"]]
+        permissions = ["system.Everyone", "vote", "userarea_edit",
+                       "edit_acl", "root", "missing"]
+        indexed = IndexedACLAuthorizationPolicy()
+        linear = ACLAuthorizationPolicy()
+        context = self.make_context(acl)
+        for principals in principal_sets:
+            for permission in permissions:
+                expected = linear.permits(context, principals, permission)
+                result = indexed.permits(context, principals, permission)
+                self.assertEqual(bool(result), bool(expected),
+                                 (principals, permission))
+                self.assertEqual(result.ace, expected.ace)
+
+    def test_memoized_per_request(self):
+        from .security import IndexedACLAuthorizationPolicy
+        request = testing.DummyRequest()
+        policy = IndexedACLAuthorizationPolicy()
+        context = self.make_context(self.acl, request)
+        first = policy.permits(context, ["system.Authenticated"], "vote")
+        second = policy.permits(context, ["system.Authenticated"], "vote")
+        self.assertTrue(first)
+        self.assertIs(first, second)
+        other = self.make_context(self.acl, testing.DummyRequest())
+        self.assertIsNot(policy.permits(other, ["system.Authenticated"],
+                                        "vote"), first)
+
+class TestUserLib(CacheTestCase):
+    def test_list_users_permissions(self):
+        from .factory import JsonList
+        from .lib.userlib import UserLib
+        u = UserLib()
+        with transaction.manager:
+            JsonList([("Allow", "group:admin", "edit_menu"),
+                      ("Deny", "group:admin", "backup"),
+                      ("Allow", "system.Authenticated", "vote")])
+            admin = u.create_group("admin", "All Access!")
+            u.create_group("system.Authenticated", "Logged in")
+            user = u.create_user("bob", "Bob", "bob@example.com", "bob",
+                                 "Male")
+            user.groups.append(admin)
+        with transaction.manager:
+            self.assertEqual(u.list_users_permissions("bob"), ["edit_menu"])
+        with transaction.manager:
+            user = u.show("bob")
+            user.groups.append(u.show_group("system.Authenticated"))
+            JsonList().append(("Allow", "group:ADMIN", "file_upload"))
+        with transaction.manager:
+            self.assertEqual(sorted(u.list_users_permissions("bob")),
+                             ["edit_menu", "file_upload", "vote"])
+
+    def test_show_group_keeps_pending_changes(self):
+        from .lib.userlib import UserLib
+        from .models import Group
+        u = UserLib()
+        with transaction.manager:
+            u.create_group("admin", "Admins")
+        with transaction.manager:
+            u.show_group("admin")
+        with transaction.manager:
+            group = DBSession.query(Group).filter_by(name="admin").one()
+            group.display_name = "Administrators"
+            self.assertIs(u.show_group("admin"), group)
+            self.assertEqual(group.display_name, "Administrators")
+        with transaction.manager:
+            self.assertEqual(u.show_group("admin").display_name,
+                             "Administrators")
+
+    def test_show_group_cached(self):
+        from .lib.userlib import UserLib, GroupNotFound
+        u = UserLib()
+        with transaction.manager:
+            u.create_group("system.Everyone", "Everyone")
+        with transaction.manager:
+            self.assertRaises(GroupNotFound, u.show_group, "admin")
+            u.create_group("admin", "All Access!")
+        with transaction.manager:
+            u.show_group("admin")
+        del self.queries[:]
+        with transaction.manager:
+            user = u.create_user("bob", "Bob", "bob@example.com", "bob",
+                                 "Male")
+            for name in ("system.Everyone", "admin"):
+                user.groups.append(u.show_group(name))
+        self.assertEqual([x for x in self.queries if x.startswith("SELECT")],
+                         [])
+        with transaction.manager:
+            self.assertEqual(sorted(x.name for x in u.show("bob").groups),
+                             ["admin", "system.Everyone"])
+
+class TestTokenLib(CacheTestCase):
+    def setUp(self):
+        super(TestTokenLib, self).setUp()
+        from .lib.userlib import UserLib
+        from .models import TokenPurpose
+        with transaction.manager:
+            DBSession.add(TokenPurpose("register"))
+            UserLib().create_user("bob", "Bob", "bob@example.com", "bob",
+                                  "Male")
+
+    def test_get_token(self):
+        from .lib.tokenlib import TokenLib, InvalidToken, InvalidPurpose
+        from .lib.userlib import UserLib
+        t = TokenLib()
+        with transaction.manager:
+            name = t.add_token(UserLib().show("bob"), "register")
+        with transaction.manager:
+            del self.queries[:]
+            self.assertEqual(t.get_token(name, False, "register").name, name)
+            self.assertEqual(len(self.queries), 1)
+            self.assertRaises(InvalidPurpose, t.get_token, name, True, "x")
+            t.get_token(name)
+        with transaction.manager:
+            self.assertRaises(InvalidToken, t.get_token, name)
+
+    def test_new_purpose_seen(self):
+        from .lib.tokenlib import TokenLib, InvalidPurpose
+        from .models import TokenPurpose
+        t = TokenLib()
+        with transaction.manager:
+            t.get_purpose("register")
+            self.assertRaises(InvalidPurpose, t.get_purpose, "forum")
+        with transaction.manager:
+            DBSession.add(TokenPurpose("forum"))
+        with transaction.manager:
+            self.assertEqual(t.get_purpose("forum").name, "forum")
+
+    def test_delete_expired(self):
+        from .lib.tokenlib import TokenLib
+        from .lib.userlib import UserLib
+        from .models import Token
+        from .scripts.sweep import sweep
+        t = TokenLib()
+        with transaction.manager:
+            user = UserLib().show("bob")
+            t.add_token(user, "register")
+            t.expire_token(DBSession.query(Token).one())
+            live = t.add_token(user, "register")
+        del self.queries[:]
+        self.assertEqual(sweep(), 1)
+        self.assertEqual(len([x for x in self.queries
+                              if x.startswith("DELETE FROM token ")]), 1)
+        with transaction.manager:
+            self.assertEqual([x.name for x in DBSession.query(Token)], [live])
+
+class TestSignedTokens(TestTokenLib):
+    def setUp(self):
+        super(TestSignedTokens, self).setUp()
+        from .lib import tokenlib
+        tokenlib.configure({"token_mode": "signed", "token_secret": "s3cr3t"})
+
+    def tearDown(self):
+        from .lib import tokenlib
+        tokenlib.configure({})
+        super(TestSignedTokens, self).tearDown()
+
+    def test_get_token(self):
+        from .lib.tokenlib import TokenLib, InvalidToken, InvalidPurpose
+        from .lib.userlib import UserLib
+        from .models import Token
+        t = TokenLib()
+        with transaction.manager:
+            name = t.add_token(UserLib().show("bob"), "register")
+        self.assertEqual(DBSession.query(Token).count(), 0)
+        with transaction.manager:
+            token = t.get_token(name, False, "register")
+            self.assertEqual(token.user.name, "bob")
+            self.assertEqual(token.purpose.name, "register")
+            self.assertRaises(InvalidPurpose, t.get_token, name, True, "x")
+            t.get_token(name)
+        with transaction.manager:
+            self.assertRaises(InvalidToken, t.get_token, name)
+        encoded, digest = name.split(".")
+        for forged in [encoded + "." + digest[::-1], encoded[1:] + "." + digest,
+                       "x.y", "x.y.z"]:
+            self.assertRaises(InvalidToken, t.get_token, forged)
+
+    def test_delete_expired(self):
+        from .lib.tokenlib import TokenLib, SignedToken
+        from .lib.userlib import UserLib
+        from .models import ConsumedToken
+        from .scripts.sweep import sweep
+        from datetime import datetime, timedelta
+        t = TokenLib()
+        with transaction.manager:
+            user = UserLib().show("bob")
+            t.get_token(t.add_token(user, "register"))
+            old = SignedToken.parse(t.add_token(user, "register"))
+            old.expires = datetime.now() - timedelta(seconds=1)
+            t.expire_token(old)
+        self.assertEqual(sweep(), 1)
+        self.assertEqual(DBSession.query(ConsumedToken).count(), 1)
+
+class TestFileLib(CacheTestCase):
+    def setUp(self):
+        super(TestFileLib, self).setUp()
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.config.registry.settings = {"static_path": self.tmpdir,
+                                         "media_queue": "true"}
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+        super(TestFileLib, self).tearDown()
+
+    def test_thumbnail_queued(self):
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+        from io import BytesIO
+        from PIL import Image
+        from .lib.filelib import FileLib
+        from .models import Files
+        from .scripts.media_worker import run
+        f = FileLib(testing.DummyRequest())
+        image = BytesIO()
+        Image.new("RGB", (512, 512)).save(image, "png")
+        image.seek(0)
+        with transaction.manager:
+            db_file = f.write("a.png", image, "image/png", True)
+            DBSession.flush()
+            file_id = db_file.id
+            self.assertFalse(db_file.upload_complete)
+            self.assertEqual(f.job_status(db_file), "pending")
+        with ProcessPoolExecutor(1) as executor:
+            self.assertEqual(run(self.config.registry.settings, executor, 2),
+                             1)
+            self.assertEqual(run(self.config.registry.settings, executor, 2),
+                             0)
+        with transaction.manager:
+            db_file = DBSession.query(Files).get(file_id)
+            self.assertTrue(db_file.upload_complete)
+            self.assertTrue(db_file.is_picture)
+            self.assertEqual(f.job_status(db_file), "done")
+            self.assertTrue(os.path.exists(os.path.join(
+                self.tmpdir, "uploads", db_file.uuid, "a.thumbnail.png")))
+
+    def test_only_stale_jobs_requeued(self):
+        from io import BytesIO
+        from .lib.filelib import FileLib
+        from .scripts.media_worker import claim, requeue
+        with transaction.manager:
+            FileLib(testing.DummyRequest()).write("a.txt", BytesIO(b"a"),
+                                                 "text/plain", True)
+        self.assertEqual(len(claim(self.config.registry.settings, 2)), 1)
+        # Another worker starting must leave the running job alone
+        self.assertEqual(requeue(), 0)
+        self.assertEqual(claim(self.config.registry.settings, 2), [])
+        self.assertEqual(requeue(-1), 1)
+        self.assertEqual(len(claim(self.config.registry.settings, 2)), 1)
+
+    def test_single_pass_ingest(self):
+        from io import BytesIO
+        from PIL import Image
+        from .lib.filelib import FileLib
+        self.config.registry.settings["media_queue"] = "false"
+        image = BytesIO()
+        Image.new("RGB", (512, 512)).save(image, "png")
+        size = image.tell()
+        image.seek(0)
+        with transaction.manager:
+            db_file = FileLib(testing.DummyRequest()).write(
+                "a.png", image, thumbnail=True)
+            self.assertEqual(db_file.mimetype, "image/png")
+            self.assertEqual(db_file.size, size)
+            self.assertTrue(db_file.upload_complete)
+
+    def test_dedup(self):
+        import os
+        from io import BytesIO
+        from .lib.filelib import FileLib
+        from .models import FileBlob
+        self.config.registry.settings["upload_dedup"] = "true"
+        f = FileLib(testing.DummyRequest())
+        with transaction.manager:
+            first = f.write("a.txt", BytesIO(b"same"), "text/plain")
+            second = f.write("b.txt", BytesIO(b"same"), "text/plain")
+            DBSession.flush()
+            self.assertIs(first.blob, second.blob)
+            self.assertEqual(first.blob.refcount, 2)
+            blob_path = f.blob_path(first.blob.digest)
+            path = os.path.join(self.tmpdir, "uploads", second.uuid, "b.txt")
+            self.assertTrue(os.path.samefile(blob_path, path))
+            f.delete(first)
+            DBSession.flush()
+            self.assertEqual(second.blob.refcount, 1)
+            self.assertTrue(os.path.exists(blob_path))
+            f.delete(second)
+            DBSession.flush()
+            self.assertEqual(DBSession.query(FileBlob).count(), 0)
+            # Only unlinked once the delete is committed
+            self.assertTrue(os.path.exists(blob_path))
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_dedup_concurrent_insert(self):
+        from io import BytesIO
+        from unittest import mock
+        from .lib import filelib
+        from .lib.filelib import FileLib
+        self.config.registry.settings["upload_dedup"] = "true"
+        f = FileLib(testing.DummyRequest())
+        with transaction.manager:
+            f.write("a.txt", BytesIO(b"same"), "text/plain")
+        # The row of another upload is not seen until the insert fails
+        ref_blob = filelib._ref_blob
+        misses = [0]
+        with mock.patch.object(filelib, "_ref_blob", side_effect=lambda d:
+                               misses.pop() if misses else ref_blob(d)):
+            with transaction.manager:
+                second = f.write("b.txt", BytesIO(b"same"), "text/plain")
+                self.assertEqual(second.blob.refcount, 2)
+
+class TestGroupfinder(CacheTestCase):
+    def test_principals_cached_until_groups_change(self):
+        from .lib.userlib import UserLib
+        from .security import groupfinder
+        u = UserLib()
+        with transaction.manager:
+            u.create_group("admin", "All Access!")
+            u.create_user("bob", "Bob", "bob@example.com", "bob", "Male")
+        request = testing.DummyRequest()
+        with transaction.manager:
+            self.assertEqual(groupfinder("bob", request), [])
+            del self.queries[:]
+            self.assertEqual(groupfinder("bob", request), [])
+            self.assertEqual(self.queries, [])
+            self.assertIsNone(groupfinder("alice", request))
+        self.assertNotIn("groupfinder", request.session)
+        with transaction.manager:
+            user = u.show("bob")
+            user.groups.append(u.show_group("admin"))
+        with transaction.manager:
+            self.assertEqual(groupfinder("bob", request), ["group:admin"])
+
+class TestGenerateMenu(CacheTestCase):
+    def setUp(self):
+        super(TestGenerateMenu, self).setUp()
+        from .lib.menulib import MenuLib
+        self.config.add_route('home', '/')
+        self.config.add_route('userarea_admin_edit_settings',
+                              '/userarea_admin/edit_setting/{name}')
+        self.config.testing_securitypolicy(userid="bob",
+                                           groupids=["group:admin"])
+        m = MenuLib()
+        with transaction.manager:
+            group = m.add_group("main_menu")
+            m.add_menu_item_route("Home", "home", 1, group,
+                                  "system.Everyone")
+            m.add_menu_item_route("Edit %(name)s",
+                                  "userarea_admin_edit_settings", 2, group,
+                                  "edit_settings", {"name": "CSS"})
+
+    def test_menu_cached(self):
+        from .factory import RootFactory
+        from .lib.widgetlib import WidgetLib
+        w = WidgetLib()
+        request = testing.DummyRequest()
+        context = RootFactory(request)
+        expected = [["http://example.com/", "Home", False],
+                    ["http://example.com/userarea_admin/edit_setting/CSS",
+                     "Edit CSS", True]]
+        self.assertEqual(w.generate_menu("main_menu", context, request),
+                         expected)
+        del self.queries[:]
+        self.assertEqual(w.generate_menu("main_menu", context, request),
+                         expected)
+        self.assertEqual(w.generate_menu("missing", context, request), [])
+        self.assertEqual(self.queries, [])
+
+    def test_show_groups_single_query(self):
+        from .lib.menulib import MenuLib
+        m = MenuLib()
+        with transaction.manager:
+            m.add_group("user_area")
+        del self.queries[:]
+        with transaction.manager:
+            groups = m.show_groups(["main_menu", "user_area", "missing"])
+            self.assertEqual(sorted(groups), ["main_menu", "user_area"])
+            self.assertEqual([x.name for x in groups["main_menu"].menu_items],
+                             ["Home", "Edit %(name)s"])
+            self.assertEqual(len(self.queries), 1)
+
+    def test_route_json_validated_on_save(self):
+        from .lib.menulib import MenuLib, InvalidRouteJson
+        m = MenuLib()
+        with transaction.manager:
+            group = m.show_group("main_menu")
+            self.assertRaises(InvalidRouteJson, m.add_menu_item_route,
+                              "Bad", "home", 3, group, "", "[1, 2]")
+            self.assertRaises(InvalidRouteJson, m.from_dict,
+                              {"main_menu": [{"name": "Bad", "type": "route",
+                                              "position": 1,
+                                              "permissions": "",
+                                              "route_name": "home",
+                                              "route_json": "{",
+                                              "url": ""}]})
+        data = m.to_dict()
+        self.assertEqual([x["route_json"] for x in data["main_menu"]],
+                         ['{}', '{"name": "CSS"}'])
+
+    def test_cached_route_url(self):
+        from .lib.helperlib import cached_route_url
+        request = testing.DummyRequest()
+        self.assertEqual(cached_route_url(request,
+                                          "userarea_admin_edit_settings",
+                                          name="CSS"),
+                         "http://example.com/userarea_admin/edit_setting/CSS")
+        request = testing.DummyRequest()
+        request.application_url = "http://example.org"
+        self.assertEqual(cached_route_url(request,
+                                          "userarea_admin_edit_settings",
+                                          name="CSS"),
+                         "http://example.org/userarea_admin/edit_setting/CSS")
+
+    def test_menu_rebuilt_on_change(self):
+        from .factory import RootFactory
+        from .lib.menulib import MenuLib
+        from .lib.widgetlib import WidgetLib
+        w = WidgetLib()
+        request = testing.DummyRequest()
+        w.generate_menu("main_menu", RootFactory(request), request)
+        with transaction.manager:
+            MenuLib().delete_group("main_menu")
+        self.assertEqual(w.generate_menu("main_menu", RootFactory(request),
+                                         request), [])
+
+class TestSearchLib(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        import os
+        import shutil
+        from .lib.searchlib import close_index
+        close_index()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def add_page(self, s, name, content, tags="python"):
+        from datetime import datetime
+        from .lib.searchlib import flush
+        s.update_index(name.title(), "/article/%s" % name, content, tags,
+                       datetime(2015, 1, 1), "page", "page_%s" % name,
+                       "admin")
+        flush()
+
+    def test_searcher_shared_and_refreshed(self):
+        from .lib.searchlib import SearchLib
+        s = SearchLib()
+        self.add_page(s, "spam", "spam and eggs")
+        searcher = s.backend.searcher("page")
+        self.assertIs(SearchLib().backend.searcher("page"), searcher)
+        self.assertEqual([x['path'] for x in s.search("eggs")],
+                         ["/article/spam"])
+        self.add_page(SearchLib(), "ham", "ham and eggs")
+        self.assertIsNot(s.backend.searcher("page"), searcher)
+        self.assertTrue(searcher.is_closed)
+        self.assertEqual(sorted(x['path'] for x in s.search("eggs")),
+                         ["/article/ham", "/article/spam"])
+
+    def test_search_pages_and_boosts(self):
+        from .lib.searchlib import SearchLib
+        s = SearchLib()
+        self.add_page(s, "eggs", "nothing to see", tags="breakfast")
+        for i in range(5):
+            self.add_page(s, "page%d" % i, "eggs number %d" % i)
+        results = s.search("eggs", 1, 2)
+        self.assertEqual(results.total, 6)
+        self.assertEqual(results.pagecount, 3)
+        self.assertEqual(len(list(results)), 2)
+        # A title match counts for more than a content match
+        self.assertEqual(results[0]['path'], "/article/eggs")
+        self.assertIn("<b", results[1]["highlights"])
+        self.assertEqual(len(list(s.search("eggs", 3, 2))), 2)
+        self.assertEqual(s.search("eggs", 1, 1000).pagecount, 1)
+        self.assertEqual(s.search("eggs", 1, 0).pagecount, 6)
+        self.assertEqual(list(s.search("")), [])
+
+    def test_writes_are_batched(self):
+        from .lib.searchlib import SearchLib, flush
+        from datetime import datetime
+        s = SearchLib()
+        for i in range(20):
+            s.update_index("Page %d" % i, "/article/%d" % i, "queued", "",
+                           datetime(2015, 1, 1), "page", "page_%d" % i,
+                           "admin")
+        s.delete_from_index("/article/0")
+        flush()
+        self.assertEqual(s.search("queued").total, 19)
+        # One commit per batch rather than one segment per document
+        self.assertLess(len(s.backend.index("page")._segments()), 20)
+
+    def test_writes_held_while_locked(self):
+        from .lib import searchlib
+        from .lib.searchlib import SearchLib
+        from datetime import datetime
+        s = SearchLib()
+        self.add_page(s, "spam", "spam and eggs")
+        lock = s.backend.index("page").lock("WRITELOCK")
+        lock.acquire()
+        retries, timeout = searchlib.LOCK_RETRIES, searchlib.LOCK_TIMEOUT
+        searchlib.LOCK_RETRIES, searchlib.LOCK_TIMEOUT = 1, 0.1
+        try:
+            with self.assertLogs(searchlib.log, "WARNING"):
+                s.update_index("Ham", "/article/ham", "ham and eggs", "",
+                               datetime(2015, 1, 1), "page", "page_ham",
+                               "admin")
+                self.assertFalse(searchlib.flush(1))
+        finally:
+            searchlib.LOCK_RETRIES, searchlib.LOCK_TIMEOUT = retries, timeout
+            lock.release()
+        self.assertTrue(searchlib.flush(30))
+        self.assertEqual(s.search("ham").total, 1)
+
+    def test_reindex_swaps_index(self):
+        import os
+        from .lib.searchlib import SearchLib, INDEX_NAME
+        from .scripts.reindex import reindex
+        from datetime import datetime
+        s = SearchLib()
+        self.add_page(s, "stale", "old eggs")
+        def provider(session):
+            for i in range(3):
+                yield dict(title="Page %d" % i, path="/article/%d" % i,
+                           content="fresh eggs", tags="", what="page",
+                           created=datetime(2015, 1, 1),
+                           item_id="page_%d" % i, username="admin")
+        self.assertEqual(reindex(None, [provider]), 3)
+        self.assertTrue(os.path.islink(INDEX_NAME))
+        self.assertEqual(SearchLib().search("eggs").total, 3)
+        first = os.path.realpath(INDEX_NAME)
+        self.assertEqual(reindex(None, [lambda x: list(provider(x))[:2]]), 2)
+        self.assertNotEqual(os.path.realpath(INDEX_NAME), first)
+        self.assertEqual(SearchLib().search("eggs").total, 2)
+        second = os.path.realpath(INDEX_NAME)
+        self.assertRaises(ValueError, reindex, None, [])
+        self.assertEqual(os.path.realpath(INDEX_NAME), second)
+
+    def test_result_cache(self):
+        from .lib.searchlib import SearchLib
+        s = SearchLib()
+        self.add_page(s, "spam", "spam and eggs")
+        first = s.search("eggs")
+        self.assertIs(s.search("  eggs "), first)
+        self.assertEqual(s.cache_info()["hits"], 1)
+        self.assertIsNot(s.search("eggs", 2), first)
+        # Committing to the index drops the cached pages
+        self.add_page(s, "ham", "ham and eggs")
+        self.assertEqual(s.search("eggs").total, 2)
+        self.assertEqual(s.cache_info()["size"], 1)
+
+    def test_highlights_escaped(self):
+        from .lib import searchlib
+        from .lib.searchlib import SearchLib
+        for backend in searchlib.BACKENDS:
+            searchlib.configure({"search_backend": backend})
+            try:
+                s = SearchLib()
+                self.add_page(s, "xss", "hello <script>alert(1)</script>")
+                result = s.search("hello")[0]["highlights"]
+                self.assertNotIn("<script>", result)
+                self.assertIn("&lt;script&gt;", result)
+                self.assertIn('<b class="match term0">hello</b>', result)
+            finally:
+                searchlib.close_index()
+                searchlib.configure({})
+
+    def test_fts5_backend(self):
+        from .lib import searchlib
+        from .lib.searchlib import SearchLib
+        searchlib.configure({"search_backend": "fts5"})
+        try:
+            s = SearchLib()
+            self.add_page(s, "eggs", "nothing to see", tags="breakfast")
+            self.add_page(s, "spam", "spam and eggs")
+            self.add_page(s, "ham", "ham and eggs")
+            results = s.search("eggs")
+            self.assertEqual(results.total, 3)
+            self.assertEqual(results[0]['path'], "/article/eggs")
+            self.assertIn("<b", results[1]["highlights"])
+            self.assertEqual(results[0]['created'].year, 2015)
+            s.delete_from_index("/article/ham")
+            searchlib.flush()
+            self.assertEqual(len(s.search("ham eggs")), 0)
+            self.assertEqual(s.search("eggs", 2, 1).pagenum, 2)
+            results = s.search("eggs", filters={"tags": "breakfast"})
+            self.assertEqual([x['path'] for x in results], ["/article/eggs"])
+            self.assertEqual(len(s.search("eggs", filters={"tags": "%"})), 0)
+            results = s.search("eggs", sortedby="-username")
+            self.assertEqual(dict(results.facets["tags"]),
+                             {"python": 1, "breakfast": 1})
+            self.assertEqual(s.complete("bre"), [("breakfast", 1)])
+        finally:
+            searchlib.close_index()
+            searchlib.configure({})
+
+    def test_index_per_content_type(self):
+        import os
+        from .lib.searchlib import SearchLib, index_names, flush
+        from .scripts.reindex import reindex_type
+        from datetime import datetime
+        s = SearchLib()
+        self.add_page(s, "spam", "spam and eggs")
+        s.update_index("Eggs thread", "/thread/1", "more eggs", "",
+                       datetime(2015, 1, 1), "thread", "thread_1", "admin")
+        flush()
+        self.assertEqual(index_names(), ["page", "thread"])
+        self.assertEqual(s.search("eggs").total, 2)
+        results = s.search("eggs", what="thread")
+        self.assertEqual([x['path'] for x in results], ["/thread/1"])
+        self.assertIn("<b", results[0]["highlights"])
+        # Rebuilding one type leaves the other sub-indexes alone
+        page_files = sorted(x for x in os.listdir("whoosh_index")
+                            if x.startswith("_page_"))
+        def provider(session):
+            yield dict(title="Ham thread", path="/thread/2", content="eggs",
+                       tags="", created=datetime(2015, 1, 1), what="thread",
+                       item_id="thread_2", username="admin")
+        self.assertEqual(reindex_type(None, [provider], "thread"), 1)
+        self.assertEqual(sorted(x for x in os.listdir("whoosh_index")
+                                if x.startswith("_page_")), page_files)
+        self.assertEqual(sorted(x['path'] for x in s.search("eggs")),
+                         ["/article/spam", "/thread/2"])
+        # Moving a document to another type removes the old copy
+        s.update_index("Spam", "/article/spam", "spam and eggs", "",
+                       datetime(2015, 1, 1), "thread", "page_spam", "admin")
+        flush()
+        self.assertEqual(s.search("spam").total, 1)
+        self.assertEqual(s.search("spam", what="page").total, 0)
+
+    def test_filters_sorting_and_facets(self):
+        from .lib.searchlib import SearchLib, flush
+        from datetime import datetime
+        s = SearchLib()
+        for i, (what, user, tags) in enumerate([
+                ("page", "admin", "python web"), ("page", "bob", "python"),
+                ("thread", "bob", "web"), ("thread", "carol", "")]):
+            s.update_index("Item %d" % i, "/%s/%d" % (what, i), "eggs", tags,
+                           datetime(2015, 1, i + 1), what, "item_%d" % i,
+                           user)
+        flush()
+        results = s.search("eggs", sortedby="-created")
+        self.assertEqual([x['path'] for x in results],
+                         ["/thread/3", "/thread/2", "/page/1", "/page/0"])
+        self.assertEqual(dict(results.facets["what"]),
+                         {"page": 2, "thread": 2})
+        self.assertEqual(dict(results.facets["tags"]),
+                         {"python": 2, "web": 2})
+        self.assertEqual(results.facets["username"][0], ("bob", 2))
+        results = s.search("eggs", filters={"username": "bob"},
+                           sortedby="created")
+        self.assertEqual([x['path'] for x in results],
+                         ["/page/1", "/thread/2"])
+        results = s.search("eggs", filters={"tags": ["web"]}, what="thread")
+        self.assertEqual([x['path'] for x in results], ["/thread/2"])
+        # Facets are counted once per query, not once per page
+        misses = s.cache_info()["facets"]["misses"]
+        s.search("eggs", 2, 1, sortedby="-created")
+        self.assertEqual(s.cache_info()["facets"]["misses"], misses)
+        self.assertRaises(ValueError, s.search, "eggs", sortedby="content")
+        self.assertRaises(ValueError, s.search, "eggs",
+                          filters={"content": "x"})
+
+    def test_complete(self):
+        from .lib.searchlib import SearchLib, flush
+        from datetime import datetime
+        s = SearchLib()
+        for i, title in enumerate(["Python tips", "Pyramid views",
+                                   "Pyramid forms", "Eggs"]):
+            s.update_index(title, "/article/%d" % i, "content", "python",
+                           datetime(2015, 1, 1), "page", "page_%d" % i,
+                           "admin")
+        flush()
+        # Documents are counted once per field the word is in
+        self.assertEqual(s.complete("py"), [("python", 5), ("pyramid", 2)])
+        self.assertEqual(s.complete("Pyr"), [("pyramid", 2)])
+        self.assertEqual(s.complete("py", 1), [("python", 5)])
+        self.assertEqual(s.complete("zz"), [])
+        self.assertEqual(s.complete(" "), [])
+        # The word list follows index changes
+        s.update_index("Pyracms", "/article/9", "content", "", None,
+                       "thread", "thread_9", "admin")
+        flush()
+        self.assertEqual(s.complete("pyra"), [("pyramid", 2), ("pyracms", 1)])
@@ -3,6 +3,7 @@ import os
 import shutil
 import uuid
 from string import Template
+from urllib.parse import urlencode
 
 import datetime
 import transaction
@@ -28,9 +29,11 @@ from .deform_schemas.userarea_admin import (EditACL, MenuGroup, EditMenuItems,
                                             EditAdminUserSchema)
 from .factory import JsonList
 from .lib.helperlib import (acl_to_dict, dict_to_acl, serialize_relation,
-                            deserialize_relation, redirect, rapid_deform)
+                            deserialize_relation, redirect, rapid_deform,
+                            is_int)
 from .lib.menulib import MenuLib
-from .lib.searchlib import SearchLib
+from .lib.searchlib import (SearchLib, PAGELEN, MAX_PAGELEN, FILTER_FIELDS,
+                            SORT_FIELDS, FACET_FIELDS)
 from .lib.settingslib import SettingsLib
 from .lib.tokenlib import TokenLib, InvalidToken
 from .lib.userlib import UserLib
@@ -71,7 +74,34 @@ def search(context, request):
     Handle search queries
     """
     s = SearchLib()
-    return {"items": s.search(request.matchdict['query'])}
+    page = request.params.get("page", "1")
+    pagelen = request.params.get("pagelen", "")
+    pagelen = min(int(pagelen), MAX_PAGELEN) if is_int(pagelen) else PAGELEN
+    what = request.params.getall("what")
+    filters = dict((x, request.params.getall(x)) for x in FILTER_FIELDS)
+    sort = request.params.get("sort", "")
+    if sort.lstrip("-") not in SORT_FIELDS:
+        sort = ""
+    items = s.search(request.matchdict['query'],
+                     int(page) if is_int(page) else 1, pagelen, what,
+                     filters, sort)
+    # Query string of the current search, less the page number
+    params = [("pagelen", pagelen)] + [("what", x) for x in what]
+    for field, values in sorted(filters.items()):
+        params.extend((field, x) for x in values)
+    facets = []
+    for field in FACET_FIELDS:
+        facets.append((field, [(value, count,
+                                urlencode(params + [(field, value)] +
+                                          [("sort", sort)]))
+                               for value, count in items.facets[field]
+                               if (field, value) not in params]))
+    sorts = [(x, urlencode(params + [("sort", x)]))
+             for x in SORT_FIELDS + tuple("-" + x for x in SORT_FIELDS)]
+    return {"items": items, "page": items.pagenum,
+            "pagecount": items.pagecount, "pagelen": pagelen,
+            "total": items.total, "facets": facets, "sorts": sorts,
+            "sort": sort, "query": urlencode(params + [("sort", sort)])}
 
 
 @view_config(route_name='css')
@@ -388,7 +418,6 @@ def userarea_logout(context, request):
     """
     Log the current user out
     """
-    request.session['groupfinder'] = {}
     headers = forget(request)
     request.session.flash(s.show_setting("INFO_LOGOUT"), INFO)
     return redirect(request, "home", headers=headers)
@@ -498,8 +527,8 @@ def userarea_admin_edit_menu_item(context, request):
                 if isinstance(item[key], str):
                     item[key] = item[key].replace("%20", " ")
             new_menu.append(item)
-        group.menu_items = deserialize_relation(new_menu, Menu,
-                                                {"group": group})
+        m.update_items(group, deserialize_relation(new_menu, Menu,
+                                                   {"group": group}))
         request.session.flash(s.show_setting("INFO_MENU_UPDATED")
                               % group.name, INFO)
         return redirect(request, 'userarea_admin_edit_menu')
@@ -557,7 +586,6 @@ def userarea_admin_edit_acl(context, request):
         Save new access control list to database
         """
         context.__acl__ = JsonList(map(dict_to_acl, deserialized['acl']))
-        request.session['groupfinder'] = {}
         request.session.flash(s.show_setting("INFO_ACL_UPDATED"), INFO)
         return redirect(request, 'home')
 
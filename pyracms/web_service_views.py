@@ -1,7 +1,6 @@
 """ Cornice services.
 """
 import json
-import magic
 import webob
 import ntpath
 from colander import MappingSchema, SchemaNode, String
@@ -12,6 +11,7 @@ from webob import Response, exc
 from .lib.filelib import FileLib, APIFileNotFound
 from .lib.userlib import UserLib, UserNotFound
 from .lib.menulib import MenuLib, MenuGroupNotFound
+from .lib.searchlib import SearchLib, COMPLETE_LIMIT
 
 APP_JSON = "application/json"
 
@@ -46,11 +46,12 @@ def valid_token(request, **kwargs):
 
 
 def valid_permission(request, permission):
-    user = request.validated['user']
-    if permission in u.list_users_permissions(user):
-        return True
-    else:
-        return False
+    permissions = request.validated.get('permissions')
+    if permissions is None:
+        user = request.validated['user']
+        permissions = set(u.list_users_permissions(user))
+        request.validated['permissions'] = permissions
+    return permission in permissions
 
 
 def valid_group(request, group):
@@ -154,6 +155,8 @@ def api_file_upload_get(request):
                 "mimetype": file_obj.file_obj.mimetype,
                 "is_picture": file_obj.file_obj.is_picture,
                 "is_video": file_obj.file_obj.is_video,
+                "upload_complete": file_obj.file_obj.upload_complete,
+                "job_status": f.job_status(file_obj.file_obj),
                 "filename": file_obj.file_obj.name}
     except APIFileNotFound:
         request.errors.add('body', 'not_found', 'UUID Not Found')
@@ -172,19 +175,18 @@ def api_file_upload_validator(request, **kwawgs):
 @file_upload.post(validators=api_file_upload_validator)
 def api_file_upload_post(request):
     f = FileLib(request)
-    magic_obj = magic.Magic(mime=True)
     post_data = request.POST['data']
-    post_file = post_data.file
-    mimetype = magic_obj.from_buffer(post_file.read(1024))
-    post_file.seek(0)
     file_upload_obj = f.api_write(ntpath.basename(post_data.filename),
-                                  post_file, mimetype)
-    return {"status": "ok", "mimetype": mimetype, "uuid": file_upload_obj.name,
+                                  post_data.file)
+    return {"status": "ok", "mimetype": file_upload_obj.file_obj.mimetype,
+            "uuid": file_upload_obj.name,
             "created": str(file_upload_obj.created),
             "expires": str(file_upload_obj.expires),
             "size": file_upload_obj.file_obj.size,
             "is_picture": file_upload_obj.file_obj.is_picture,
             "is_video": file_upload_obj.file_obj.is_video,
+            "upload_complete": file_upload_obj.file_obj.upload_complete,
+            "job_status": f.job_status(file_upload_obj.file_obj),
             "filename": file_upload_obj.file_obj.name}
 
 guest_token = Service(name='guest_token', path='/api/guest_token',
@@ -215,7 +217,7 @@ menu_list = Service(name='menu_group_item', path='/api/menu/list',
 def api_valid_menu_group(request, **kwargs):
     if valid_qs(request, "group"):
         try:
-            m.show_group(request.params['group'])
+            m.compiled_group(request.params['group'])
         except MenuGroupNotFound:
             request.errors.add('querystring', 'not_found',
                                'group not found in database.')
@@ -223,20 +225,36 @@ def api_valid_menu_group(request, **kwargs):
 @menu_list.get(validators=(valid_token, api_valid_menu_group))
 def get_menu_group(request):
     grp_name = request.params['group']
-    grp_obj = m.show_group(grp_name)
     result = {}
-    for item in grp_obj.menu_items:
-        if not valid_permission(request, item.permissions):
+    for item in m.compiled_group(grp_name):
+        permissions = ",".join(item.permissions)
+        if not valid_permission(request, permissions):
             continue
         url = ""
         update = {}
         if item.type == "route":
             update = {"route_name": item.route_name,
-                      "route_json": json.loads(item.route_json)}
+                      "route_json": item.route_args}
         else:
             url = item.url
         result[item.position] = {"name": item.name, "web_url": url,
-                                 "permissions": item.permissions,
+                                 "permissions": permissions,
                                  "type": item.type, "id": item.id}
         result[item.position].update(update)
-    return result
\ No newline at end of file
+    return result
+
+search_complete = Service(name='search_complete', path='/api/search/complete',
+                          description="Complete a word typed in the search "
+                                      "box")
+
+
+def api_valid_complete(request, **kwargs):
+    if valid_qs(request, "q") and request.params.get("limit"):
+        valid_qs_int(request, "limit")
+
+
+@search_complete.get(validators=(api_valid_complete,))
+def get_search_complete(request):
+    limit = int(request.params.get("limit") or COMPLETE_LIMIT)
+    return [{"term": term, "count": count} for term, count in
+            SearchLib().complete(request.params['q'], limit)]
@@ -53,5 +53,9 @@ setup(name='pyracms',
       main = pyracms:main
       [console_scripts]
       initialize_pyracms_db = pyracms.scripts.initializedb:main
+      reindex_pyracms_search = pyracms.scripts.reindex:main
+      benchmark_pyracms_search = pyracms.scripts.benchmark_search:main
+      sweep_pyracms = pyracms.scripts.sweep:main
+      media_pyracms_worker = pyracms.scripts.media_worker:main
       """,
       )